@@ -0,0 +1,228 @@
+"""
+Benchmarks for the NeedleChain harness itself (no GPU needed).
+
+Times dataset generation, prompt construction, request dispatch against the mock server and
+scoring, appends the results to a JSONL history file and compares runs to catch slowdowns.
+
+Usage:
+    python benchmark.py run                     # full suite, appended to ./benchmarks/history.jsonl
+    python benchmark.py run --quick --only dispatch,evaluate
+    python benchmark.py compare --threshold 0.1 # latest run vs the previous one; exit 1 on regressions
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+from openai import AsyncOpenAI
+
+from utils import JsonlWriter, iter_jsonl
+from make_data import prepare_chain, prepare_chains
+from inference_call import load_dataset, build_prompts, prepare_jobs
+from request_engine import RateLimitedClient, run_jobs
+from evaluate import score_file
+from mock_server import serve
+
+BENCHMARKS = ['make_data', 'prepare_data', 'dispatch', 'evaluate']
+K_LIST = [5, 10, 20, 50, 100, 200, 500, 1000]
+CONCURRENCY_LIST = [1, 8, 32, 128]
+# sizes of the arguments left unset, for a full and a --quick run
+FULL_SIZES = {'k_list': K_LIST, 'concurrency_list': CONCURRENCY_LIST, 'rows': 1000, 'legacy_rows': 100, 'repeat': 3}
+QUICK_SIZES = {'k_list': [5, 50, 200], 'concurrency_list': [1, 32], 'rows': 100, 'legacy_rows': 20, 'repeat': 1}
+
+
+def timed(fn, repeat=3):
+    """Best wall time of ``repeat`` calls to ``fn``, and the last return value."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def record(name, params, seconds, items, unit):
+    print(f"{name:<28} {format_params(params):<32} {seconds:9.4f}s  {items / seconds:12.1f} {unit}/s")
+    return {'benchmark': name, 'params': params, 'seconds': seconds, 'items': items,
+            'rate': items / seconds, 'unit': unit}
+
+
+def format_params(params):
+    return ' '.join(f'{key}={value}' for key, value in sorted(params.items()))
+
+
+def bench_make_data(args, workdir):
+    results = []
+    for k in args.k_list:
+        seconds, _ = timed(lambda: [prepare_chain(idx, k=k) for idx in range(args.legacy_rows)], args.repeat)
+        results.append(record('make_data.prepare_chain', {'k': k}, seconds, args.legacy_rows, 'rows'))
+        seconds, _ = timed(lambda: prepare_chains(args.rows, k=k, seed=0), args.repeat)
+        results.append(record('make_data.prepare_chains', {'k': k}, seconds, args.rows, 'rows'))
+    return results
+
+
+def write_dataset(workdir, k, n):
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    filename = os.path.join(data_dir, f'k{k}---val1600.jsonl')
+    if not os.path.exists(filename):
+        with JsonlWriter(filename) as writer:
+            for row in prepare_chains(n, k=k, seed=0):
+                writer.write(row)
+    return data_dir
+
+
+def bench_prepare_data(args, workdir):
+    results = []
+    for k in args.k_list:
+        data_dir = write_dataset(workdir, k, args.rows)
+        seconds, _ = timed(lambda: build_prompts(load_dataset(k, 1600, data_dir), 'chaotic', 'single'),
+                           args.repeat)
+        results.append(record('inference_call.prepare_data', {'k': k}, seconds, args.rows, 'prompts'))
+    return results
+
+
+def bench_dispatch(args, workdir):
+    server = serve(latency=args.latency)
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    messages, data = build_prompts(load_dataset(20, 1600, write_dataset(workdir, 20, args.rows)), 'forward', 'single')
+    results = []
+    try:
+        for concurrency in args.concurrency_list:
+            def dispatch():
+                output_name = os.path.join(workdir, f'dispatch_c{concurrency}.jsonl')
+                if os.path.exists(output_name):
+                    os.remove(output_name)
+                jobs, store = prepare_jobs(data, messages, output_name)
+                client = RateLimitedClient(AsyncOpenAI(base_url=base_url, api_key="needlechain", max_retries=0))
+                asyncio.run(run_jobs(client, jobs, concurrency=concurrency, model='mock'))
+                store.close()
+            seconds, _ = timed(dispatch, args.repeat)
+            results.append(record('request_engine.dispatch', {'concurrency': concurrency, 'latency': args.latency},
+                                  seconds, len(data), 'requests'))
+    finally:
+        server.shutdown()
+    return results
+
+
+def bench_evaluate(args, workdir):
+    rows = args.rows * 10
+    filename = os.path.join(workdir, 'results', 'bench__forward__k20__single.jsonl')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with JsonlWriter(filename) as writer:
+        for idx in range(rows):
+            writer.write({'idx': idx, 'question': 'q' * 2000, 'target': 1600,
+                          'generated': 'Following the salary facts. ' * 40 + '## Answer: 1600'})
+    seconds, (_, entry) = timed(lambda: score_file(filename, limit=0), args.repeat)
+    results = [record('evaluate.score_file', {'cache': 'cold'}, seconds, rows, 'rows')]
+    seconds, _ = timed(lambda: score_file(filename, limit=0, cached=entry), args.repeat)
+    results.append(record('evaluate.score_file', {'cache': 'warm'}, seconds, rows, 'rows'))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    for key, value in (QUICK_SIZES if args.quick else FULL_SIZES).items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    selected = args.only.split(',') if args.only else BENCHMARKS
+    run_info = {
+        'run_id': datetime.now().strftime('%Y%m%d-%H%M%S'),
+        'commit': git_commit(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'quick': args.quick,
+    }
+    print(f"run {run_info['run_id']} (commit {run_info['commit']})")
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in selected:
+            results.extend(globals()[f'bench_{name}'](args, workdir))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    with JsonlWriter(args.history, mode='a') as writer:
+        for result in results:
+            writer.write({**run_info, **result})
+    print(f"\n{len(results)} results appended to {args.history}")
+
+
+def load_runs(filename):
+    runs = {}
+    for row in iter_jsonl(filename):
+        runs.setdefault(row['run_id'], []).append(row)
+    return runs
+
+
+def compare(args):
+    """Compare the latest run with a baseline run; returns the number of regressions."""
+    runs = load_runs(args.history)
+    run_ids = sorted(runs)
+    current_id = args.current or run_ids[-1]
+    # quick and full runs use different sizes, so only runs of the same kind are compared
+    quick = runs[current_id][0]['quick']
+    previous = [run_id for run_id in run_ids if run_id < current_id and runs[run_id][0]['quick'] == quick]
+    baseline_id = args.baseline or (previous[-1] if previous else None)
+    if baseline_id is None:
+        print(f"nothing to compare: no earlier {'quick' if quick else 'full'} run in {args.history}")
+        return 0
+
+    def key(row):
+        return row['benchmark'], format_params(row['params'])
+
+    baseline = {key(row): row for row in runs[baseline_id]}
+    print(f"baseline {baseline_id} ({runs[baseline_id][0]['commit']}) -> "
+          f"current {current_id} ({runs[current_id][0]['commit']})\n")
+    regressions = 0
+    for row in runs[current_id]:
+        base = baseline.get(key(row))
+        if base is None:
+            continue
+        change = row['rate'] / base['rate'] - 1
+        flag = ''
+        if change < -args.threshold:
+            flag = '  << REGRESSION'
+            regressions += 1
+        print(f"{row['benchmark']:<28} {key(row)[1]:<32} {base['rate']:12.1f} -> {row['rate']:12.1f} "
+              f"{row['unit']}/s ({change:+.1%}){flag}")
+    print(f"\n{regressions} regression(s) beyond {args.threshold:.0%}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['run', 'compare'])
+    parser.add_argument('--history', default='./benchmarks/history.jsonl', help='JSONL file results are appended to')
+    parser.add_argument('--only', default=None, help=f"comma-separated subset of {','.join(BENCHMARKS)}")
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes and a single repeat for the size options below that are not given')
+    parser.add_argument('--rows', type=int, default=None, help='dataset rows per k (evaluate scores 10x this; 1000)')
+    parser.add_argument('--legacy_rows', type=int, default=None, help='rows timed for the per-row prepare_chain (100)')
+    parser.add_argument('--repeat', type=int, default=None, help='repeats per benchmark; the best time is kept (3)')
+    parser.add_argument('--k_list', type=lambda s: [int(k) for k in s.split(',')], default=None,
+                        help=f"comma-separated k ({','.join(map(str, K_LIST))})")
+    parser.add_argument('--concurrency_list', type=lambda s: [int(c) for c in s.split(',')], default=None,
+                        help=f"comma-separated dispatch concurrency ({','.join(map(str, CONCURRENCY_LIST))})")
+    parser.add_argument('--latency', default='fixed:0.01', help='mock server latency for the dispatch benchmark')
+    parser.add_argument('--baseline', default=None, help='run_id to compare against (default: the previous run)')
+    parser.add_argument('--current', default=None, help='run_id to check (default: the latest run)')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative throughput drop flagged as a regression')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args)
+    else:
+        sys.exit(1 if compare(args) else 0)
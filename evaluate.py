@@ -2,34 +2,237 @@ from utils import *
 import numpy as np
 import ast
 import re
+import csv
+import heapq
+import hashlib
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+INTEGER_PATTERN = re.compile(r'\b(?:\d{1,3}(?:,\d{3})+|\d+)\b')
+NAME_PATTERNS = [
+    # inference_all.py: {model}__{chain_type}__k{k}__{question_type}
+    re.compile(r'^(?P<model>.+)__(?P<chain_type>[a-z]+)__k(?P<k>\d+)__(?P<question_type>[a-z]+)$'),
+    # run_local.py: {model}_{chain_type}_{question_type}_k{k}
+    re.compile(r'^(?P<model>.+)_(?P<chain_type>parallel|forward|backward|chaotic)_(?P<question_type>single|total)_k(?P<k>\d+)$'),
+]
+SCORE_COLUMNS = ['file', 'model', 'chain_type', 'k', 'question_type', 'n', 'correct', 'parse_fail',
+                 'accuracy', 'parse_failure_rate', 'samples', 'majority_accuracy']
+OUTCOME_FIELDS = 6  # idx + score_row(); entries of older score caches have fewer and are rescored
+
 
 def extract_all_integers(text):
-    pattern = r'\b(?:\d{1,3}(?:,\d{3})+|\d+)\b'
-    matches = re.findall(pattern, text)
+    matches = INTEGER_PATTERN.findall(text)
     return [int(num.replace(',', '')) for num in matches]
 
 
-def main():
-    results_dir = './results'
-    for item in os.listdir(results_dir):
-        if not item.endswith('.jsonl'):
+def parse_answer(generated):
+    """Integer after the last '## Answer:' of a generation, or None if there is none."""
+    if not isinstance(generated, str):
+        return None
+    hyp = generated.split('## Answer:')[-1].replace('\n', '').replace(' ', '')
+    match = INTEGER_PATTERN.search(hyp)
+    if match is None:
+        return None
+    return int(match.group().replace(',', ''))
+
+
+def score_row(row):
+    """Return (correct, parse_failed, samples, correct_samples, majority_correct) for one result row.
+
+    ``generated`` is one completion or, from ``--n`` sampling, a list of them. ``correct`` and
+    ``parse_failed`` describe the first sample, so accuracy stays comparable to single-sample
+    runs; the majority vote is over the parsed answers, ties going to the earliest answer.
+    """
+    generated = row.get('generated')
+    samples = (generated or [None]) if isinstance(generated, list) else [generated]
+    target = int(float(row['target']))
+    answers = [parse_answer(sample) for sample in samples]
+    votes = Counter(answer for answer in answers if answer is not None)
+    majority = votes.most_common(1)[0][0] if votes else None
+    return (answers[0] == target, answers[0] is None, len(samples),
+            sum(answer == target for answer in answers), majority == target)
+
+
+def pass_at_k(samples, correct, k):
+    """Unbiased pass@k per row (Chen et al., 2021); NaN where a row has fewer than k samples."""
+    samples = np.asarray(samples, dtype=np.float64)
+    correct = np.asarray(correct, dtype=np.float64)
+    result = np.full(len(samples), np.nan)
+    for i, (n, c) in enumerate(zip(samples, correct)):
+        if n < k:
             continue
-        result = read_jsonl(os.path.join(results_dir, item))[:100]
-        acc_all = []
-        for item_ in result:
-            ref = float(item_['target'])
-            hyp = item_['generated'].split('## Answer:')[-1].replace('\n', '').replace(' ', '')
-            try:
-                # hyp = re.findall("\d+", hyp)[0]
-                hyp = extract_all_integers(hyp)[0]
-                acc_all.append(int(ref) == int(hyp))
-            except:
-                acc_all.append(False)
-        name = '\t'.join(item.replace('.jsonl', '').split('__'))
-        print(f"{name} \t {np.mean(acc_all)}")
+        # 1 - C(n - c, k) / C(n, k), as a product to avoid large binomials
+        result[i] = 1.0 if n - c < k else 1.0 - np.prod(1.0 - k / np.arange(n - c + 1, n + 1))
+    return result
+
+
+def parse_result_name(filename):
+    name = os.path.basename(filename).replace('.jsonl', '')
+    for pattern in NAME_PATTERNS:
+        match = pattern.match(name)
+        if match:
+            return match.groupdict()
+    return {'model': name, 'chain_type': '', 'k': '', 'question_type': ''}
+
+
+def scan_outcomes(filename, offset=0, hasher=None):
+    """Score complete lines from byte ``offset`` on; returns outcomes, the new offset and the hasher.
+
+    A trailing line without a newline (a row still being written) is left for the next scan.
+    """
+    hasher = hasher or hashlib.sha1()
+    outcomes = []
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            hasher.update(line)
+            offset += len(line)
+            if line.strip():
+                row = json_loads(line)
+                outcomes.append((row['idx'],) + score_row(row))
+    return outcomes, offset, hasher
+
+
+def hash_prefix(filename, length, chunk_size=1 << 20):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            length -= len(chunk)
+    return hasher
+
+
+def score_file(filename, limit=100, cached=None, pass_k=()):
+    """Score the ``limit`` lowest-idx rows of a result file (all rows if ``limit`` is 0).
+
+    ``cached`` is this file's entry from the score cache. An unchanged file (same size and
+    mtime) is not read at all; a file that only grew is scored from the cached byte offset
+    once the hash of the already-scored prefix matches. Besides first-sample accuracy the score
+    has the majority-vote accuracy and ``pass@k`` for each k in ``pass_k`` over the rows' samples.
+    Returns the score and the new entry.
+    """
+    if cached and cached['outcomes'] and len(cached['outcomes'][0]) != OUTCOME_FIELDS:
+        cached = None
+    stat = os.stat(filename)
+    if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+        entry = cached
+    else:
+        outcomes, offset, hasher = [], 0, None
+        if cached and stat.st_size >= cached['offset']:
+            prefix = hash_prefix(filename, cached['offset'])
+            if prefix.hexdigest() == cached['hash']:
+                outcomes, offset, hasher = [tuple(o) for o in cached['outcomes']], cached['offset'], prefix
+        new_outcomes, offset, hasher = scan_outcomes(filename, offset, hasher)
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'offset': offset,
+            'hash': hasher.hexdigest(),
+            'outcomes': outcomes + new_outcomes,
+        }
+
+    outcomes = [tuple(o) for o in entry['outcomes']]
+    if limit:
+        outcomes = heapq.nsmallest(limit, outcomes)
+    outcomes = np.array(outcomes, dtype=np.int64).reshape(-1, OUTCOME_FIELDS)
+    n = len(outcomes)
+    correct = int(outcomes[:, 1].sum())
+    parse_fail = int(outcomes[:, 2].sum())
+    score = {
+        'file': os.path.basename(filename),
+        **parse_result_name(filename),
+        'n': n,
+        'correct': correct,
+        'parse_fail': parse_fail,
+        'accuracy': correct / n if n else float('nan'),
+        'parse_failure_rate': parse_fail / n if n else float('nan'),
+        'samples': float(outcomes[:, 3].mean()) if n else float('nan'),
+        'majority_accuracy': float(outcomes[:, 5].mean()) if n else float('nan'),
+    }
+    for k in pass_k:
+        per_row = pass_at_k(outcomes[:, 3], outcomes[:, 4], k)
+        score[f'pass@{k}'] = float(np.nanmean(per_row)) if n and not np.isnan(per_row).all() else float('nan')
+    return score, entry
+
+
+def load_score_cache(filename):
+    if os.path.exists(filename):
+        try:
+            return read_json(filename)
+        except (OSError, ValueError):
+            print(f'ignoring unreadable score cache: {filename}')
+    return {}
+
+
+def save_score_cache(cache, filename):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        f.write(json_dumps(cache))
+    os.replace(tmp_filename, filename)
+
+
+def write_scores(scores, filename, pass_k=()):
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SCORE_COLUMNS + [f'pass@{k}' for k in pass_k], delimiter='\t')
+        writer.writeheader()
+        writer.writerows(scores)
+
+
+def print_breakdown(scores, key):
+    totals = defaultdict(lambda: np.zeros(2, dtype=np.int64))
+    for score in scores:
+        totals[(score['model'], score[key])] += (score['correct'], score['n'])
+    print(f"\n# accuracy by model / {key}")
+    for (model, value), (correct, n) in sorted(totals.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+        print(f"{model}\t{value}\t{correct / max(n, 1):.4f}\t(n={n})")
+
+
+def main(args):
+    files = sorted(
+        os.path.join(args.results_dir, item) for item in os.listdir(args.results_dir)
+        if item.endswith('.jsonl')
+    )
+    cache_filename = os.path.join(args.results_dir, '.score_cache.json')
+    cache = {} if args.no_cache else load_score_cache(cache_filename)
+    cached = [cache.get(os.path.basename(filename)) for filename in files]
+    pass_k = [int(k) for k in args.pass_k.split(',')] if args.pass_k else []
+    if args.workers > 1:
+        with ProcessPoolExecutor(args.workers) as pool:
+            results = list(pool.map(score_file, files, [args.limit] * len(files), cached, [pass_k] * len(files)))
+    else:
+        results = [score_file(filename, args.limit, entry, pass_k) for filename, entry in zip(files, cached)]
+    scores = [score for score, _ in results]
+    save_score_cache({os.path.basename(f): entry for f, (_, entry) in zip(files, results)}, cache_filename)
+
+    for score in scores:
+        name = '\t'.join(score['file'].replace('.jsonl', '').split('__'))
+        line = f"{name} \t {score['accuracy']} \t parse_fail={score['parse_failure_rate']:.3f}"
+        if score['samples'] > 1:
+            line += f" \t majority={score['majority_accuracy']:.4f} \t " + ' '.join(
+                f"pass@{k}={score[f'pass@{k}']:.4f}" for k in pass_k)
+        print(line)
+    print_breakdown(scores, 'k')
+    print_breakdown(scores, 'chain_type')
+
+    output = args.output or os.path.join(args.results_dir, 'scores.tsv')
+    write_scores(scores, output, pass_k)
+    print(f"\nscore table saved: {output}")
 
 
 if __name__ == '__main__':
     print(':)')
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results_dir', default='./results')
+    parser.add_argument('--limit', type=int, default=100, help='rows scored per file, lowest idx first (0 = all)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='scoring processes')
+    parser.add_argument('--no_cache', action='store_true', help='rescore every file instead of using .score_cache.json')
+    parser.add_argument('--output', default=None, help='score table path (default: <results_dir>/scores.tsv)')
+    parser.add_argument('--pass_k', default='1,5', help='comma-separated k for pass@k over rows with several samples')
+    main(parser.parse_args())
     print(';)')
@@ -1,33 +1,132 @@
 import os
-import numpy as np
+import asyncio
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--model', default='QwQ')
-args = parser.parse_args()
+from utils import model_arg_dict
+from inference_call import BATCH_MODELS, CHAT_MODELS, LOCAL_BASE_URL, MIN_OUTPUT_TOKENS
+from inference_call import dataset_path, load_dataset, build_prompts, prepare_jobs, token_lengths, make_client
+from inference_call import streaming_client, sampling_params
+from inference_call import main as run_cell
+from request_engine import SCHEDULES, LENGTH_SCHEDULES, EndpointPool, run_jobs
+from telemetry import open_telemetry
+from response_cache import open_cache
 
 chain_type_list = ['parallel', 'forward', 'backward', 'chaotic']
 k_list = [5, 10, 20, 50, 100, 200]
 question_type_list = ['single', 'total']
 
 
-for chain_type in chain_type_list:
+def cell_name(model, chain_type, k, question_type):
+    return f"{model}__{chain_type}__k{str(k)}__{question_type}"
+
+
+def build_sweep(model, results_dir, val=1600, data_dir='./data', ordered=True, max_model_len=0,
+                min_output_tokens=MIN_OUTPUT_TOKENS, use_index=False):
+    """Load each dataset once and turn every (chain_type, k, question_type) cell into engine jobs.
+
+    With ``max_model_len`` the dataset's token index is used to skip prompts that do not fit;
+    ``use_index`` loads it just for the prompt lengths used by length-aware schedules.
+    """
+    jobs, stores = [], []
     for k in k_list:
-        for question_type in question_type_list:
-            output_name = f"{args.model}__{chain_type}__k{str(k)}__{question_type}"
-            print(output_name)
-            os.system(f"""
-python inference_call.py \
---model_name {args.model} \
---output_name {output_name} \
---chain_type {chain_type} \
---question_type {question_type} \
---k {k} \
---results_dir ./results
-wait
-""")
-
-#     --tool \
+        if not os.path.exists(dataset_path(k, val, data_dir)):
+            print(f'skip k={k}: no dataset in {data_dir}')
+            continue
+        rows = load_dataset(k, val, data_dir)
+        for chain_type in chain_type_list:
+            for question_type in question_type_list:
+                output_name = cell_name(model, chain_type, k, question_type)
+                messages, data = build_prompts(rows, chain_type, question_type)
+                lengths = None
+                if max_model_len or use_index:
+                    lengths = token_lengths(model, k, val, chain_type, question_type, data_dir)
+                cell_jobs, store = prepare_jobs(data, messages, os.path.join(results_dir, f'{output_name}.jsonl'),
+                                                ordered=ordered, lengths=lengths, max_model_len=max_model_len,
+                                                min_output_tokens=min_output_tokens,
+                                                tags={'model': model, 'chain_type': chain_type, 'k': k,
+                                                      'question_type': question_type})
+                print(f'{output_name}: {len(cell_jobs)} requests')
+                jobs.extend(cell_jobs)
+                stores.append(store)
+    return jobs, stores
+
+
+def run_sweep(args):
+    os.makedirs(args.results_dir, exist_ok=True)
+    jobs, stores = build_sweep(args.model, args.results_dir, val=args.val, ordered=args.schedule == 'fifo',
+                               max_model_len=args.max_model_len, min_output_tokens=args.min_output_tokens,
+                               use_index=args.schedule in LENGTH_SCHEDULES)
+    client = make_client(args, base_url=args.base_url, api_key="needlechain")
+    if args.stream or args.early_stop:
+        client = streaming_client(client, early_stop=args.early_stop)
+    telemetry = open_telemetry(args.results_dir, args.model)
+    cache = open_cache(args.results_dir, enabled=not args.no_cache)
+    try:
+        meter = asyncio.run(run_jobs(
+            client, jobs, concurrency=args.concurrency, schedule=args.schedule, telemetry=telemetry, cache=cache,
+            model=model_arg_dict[args.model],
+            **sampling_params(args.n_samples)
+        ))
+        print(meter.summary())
+        print(meter.latency_report())
+        if isinstance(client, EndpointPool):
+            print(client.report())
+    finally:
+        telemetry.close()
+        if cache is not None:
+            cache.close()
+        for store in stores:
+            store.close()
+
+
+def run_openai_sweep(args):
+    # API models keep their batch/chat paths, but each cell still runs in this process
+    for chain_type in chain_type_list:
+        for k in k_list:
+            for question_type in question_type_list:
+                output_name = cell_name(args.model, chain_type, k, question_type)
+                if not os.path.exists(dataset_path(k, args.val)):
+                    continue
+                print(output_name)
+                run_cell(argparse.Namespace(
+                    model_name=args.model, openai_apikey=args.openai_apikey, tool=args.tool,
+                    chain_type=chain_type, question_type=question_type, k=k, val=args.val,
+                    output_name=output_name, results_dir=args.results_dir,
+                    concurrency=args.concurrency, schedule=args.schedule, base_url=args.base_url,
+                    timeout=args.timeout, max_retries=args.max_retries,
+                    batch_wait=False, poll_interval=60,
+                    max_model_len=0, min_output_tokens=args.min_output_tokens,
+                    stream=False, early_stop=False, no_cache=args.no_cache, n_samples=args.n_samples,
+                ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='QwQ')
+    parser.add_argument('--val', type=int, default=1600)
+    parser.add_argument('--results_dir', default='./results')
+    parser.add_argument('--concurrency', type=int, default=64, help='max in-flight requests across the whole sweep')
+    parser.add_argument('--schedule', default='prefix', choices=SCHEDULES)
+    parser.add_argument('--timeout', type=float, default=600, help='per-request timeout in seconds')
+    parser.add_argument('--max_retries', type=int, default=8)
+    parser.add_argument('--max_model_len', type=int, default=0,
+                        help='skip prompts that do not fit this context (needs token_index.py output; 0 = off)')
+    parser.add_argument('--min_output_tokens', type=int, default=MIN_OUTPUT_TOKENS)
+    parser.add_argument('--base_url', default=LOCAL_BASE_URL, help='comma-separated endpoints are load balanced')
+    parser.add_argument('--n_samples', type=int, default=1, help='completions sampled per prompt in one request')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='neither read nor fill the response cache in <results_dir>/.cache')
+    parser.add_argument('--stream', action='store_true', help='stream completions and record time to first token')
+    parser.add_argument('--early_stop', action='store_true',
+                        help='stream and cancel each generation once a complete "## Answer: <number>" line arrived')
+    parser.add_argument('--openai_apikey', default='OpenAI API key')
+    parser.add_argument('--tool', default=False, action='store_true')
+    args = parser.parse_args()
+
+    if args.model in BATCH_MODELS or args.model in CHAT_MODELS:
+        run_openai_sweep(args)
+    else:
+        run_sweep(args)
 
 # nohup python inference_all.py --model QwQ > logs/inference &  # 11
 # nohup python inference_all.py --model qwen2.5-32B > logs/inference &  # 12
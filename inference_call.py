@@ -1,34 +1,57 @@
 import os
-import json
+import asyncio
 import argparse
+import functools
 
 import setproctitle
-from tqdm import tqdm
 
-from openai import OpenAI
-from make_data import SYSTEM_PROMPT, TEMPLATE, QUESTIONS
-from utils import model_arg_dict, read_jsonl, write_jsonl, writer_jsonl
+from openai import OpenAI, AsyncOpenAI
+from make_data import SYSTEM_PROMPT, TEMPLATE, QUESTIONS, ChainDataset
+from utils import model_arg_dict, read_jsonl, write_jsonl, ResultStore, probe_health
 from run_openai import run_chat, run_batch, process_data
+from request_engine import SCHEDULES, LENGTH_SCHEDULES, OrderedWriter, RateLimitedClient, EndpointPool, run_jobs
+from request_engine import stream_chat_request
+from telemetry import open_telemetry
+from response_cache import open_cache
 
 
-def prepare_data(args):
-    results_dir = './data'
-    output_name = os.path.join(results_dir, f'k{str(args.k)}---val{str(args.val)}.jsonl')
-    data = read_jsonl(output_name)
+BATCH_MODELS = ['gpt-4o', 'gpt-4.1-2025-04-14', 'gpt-4o-2024-08-06', 'gpt-4.1-mini-2025-04-14']
+CHAT_MODELS = ['o3', 'o3-mini', 'o3-2025-04-16', 'o3-mini-2025-01-31']
+SAMPLING_PARAMS = {'temperature': 0.6, 'top_p': 0.95}
+LOCAL_BASE_URL = "http://localhost:8123/v1"
+MIN_OUTPUT_TOKENS = 1024
+TEMPLATE_MARGIN = 32  # chat templates of models in one tokenizer family differ by a few special tokens
+
+
+def dataset_path(k, val, data_dir='./data'):
+    """Path of the k/val dataset: rendered .jsonl if present, otherwise the compact .npz."""
+    path = os.path.join(data_dir, f'k{str(k)}---val{str(val)}.jsonl')
+    if not os.path.exists(path) and os.path.exists(path[:-len('.jsonl')] + '.npz'):
+        path = path[:-len('.jsonl')] + '.npz'
+    return path
+
 
-    def make_single(item, args):
+def load_dataset(k, val, data_dir='./data'):
+    path = dataset_path(k, val, data_dir)
+    if path.endswith('.npz'):
+        return ChainDataset(path)
+    return read_jsonl(path)
+
+
+def build_prompts(rows, chain_type, question_type):
+    def make_single(item):
         idx = item['idx']
-        question = QUESTIONS[args.question_type].replace('{p1}', item[f"{args.chain_type}_lastname"])
-        target = item[f"{args.chain_type}_{args.question_type}_val"]
+        question = QUESTIONS[question_type].replace('{p1}', item[f"{chain_type}_lastname"])
+        target = item[f"{chain_type}_{question_type}_val"]
         tmp_template = TEMPLATE.replace(
             '{names}', item['names']).replace(
-            '{context}', item[f'{args.chain_type}_chain']).replace(
+            '{context}', item[f'{chain_type}_chain']).replace(
             '{question}', question).replace(
             '{num_names}', str(len(item['names'].split(', ')))
         )
         return {'idx': idx, 'question': tmp_template, 'target': target}
 
-    data = [make_single(item, args) for item in data]
+    data = [make_single(item) for item in rows]
     processed = [
         [
             {"role": "system", "content": SYSTEM_PROMPT},
@@ -39,33 +62,106 @@ def prepare_data(args):
     return processed, data
 
 
-def run_hf(client, data, messages, output_name, **kwargs):
-    model_name = kwargs['model_name']
-    output = []
+def prepare_data(args):
+    return build_prompts(load_dataset(args.k, args.val), args.chain_type, args.question_type)
+
+
+def token_lengths(model_name, k, val, chain_type, question_type, data_dir='./data'):
+    """Prompt token counts by idx from the dataset's token index (see token_index.py), or None."""
+    from token_index import tokenizer_family, load_token_lengths
+
+    lengths = load_token_lengths(dataset_path(k, val, data_dir), tokenizer_family(model_name), chain_type, question_type)
+    if lengths is None:
+        print(f'no token index for k={k} ({tokenizer_family(model_name)}); run token_index.py to build it')
+    return lengths
+
 
-    exists_, writer_ = writer_jsonl(output_name)
-    exists_ids = [i['idx'] for i in exists_]
+def prepare_jobs(data, messages, output_name, ordered=True, lengths=None, max_model_len=0,
+                 min_output_tokens=MIN_OUTPUT_TOKENS, tags=None):
+    """Skip rows already in ``output_name`` and return request-engine jobs for the rest.
 
-    for idx, (message, d) in tqdm(enumerate(zip(messages, data))):
-        if d['idx'] in exists_ids:
-            entry = exists_[exists_ids.index(idx)]
-            writer_.write(json.dumps(entry) + '\n')
-            writer_.flush()
+    ``lengths`` maps idx to prompt tokens (see ``token_lengths``); each job then carries its
+    ``tokens``. With ``max_model_len`` as well, rows leaving fewer than ``min_output_tokens``
+    for the answer are skipped and ``max_tokens`` is set to the remaining context. ``tags``
+    (model, chain_type, k, question_type) label the jobs' telemetry rows.
+    """
+    store = ResultStore(output_name)
+    sink = OrderedWriter(store, ordered=ordered)
+    jobs = []
+    too_long = 0
+    for message, d in zip(messages, data):
+        if d['idx'] in store:
             continue
-        # try:
-        completion = client.chat.completions.create(
+        job = {'message': message, 'entry': d, 'sink': sink, 'tags': tags or {}}
+        if lengths is not None and d['idx'] in lengths:
+            job['tokens'] = lengths[d['idx']]
+            if max_model_len:
+                budget = max_model_len - job['tokens'] - TEMPLATE_MARGIN
+                if budget < min_output_tokens:
+                    too_long += 1
+                    continue
+                job['params'] = {'max_tokens': budget}
+        job['pos'] = len(jobs)
+        jobs.append(job)
+    if too_long:
+        print(f'{output_name}: skipped {too_long} prompts that leave < {min_output_tokens} tokens of {max_model_len}')
+    return jobs, store
+
+
+def streaming_client(client, early_stop=False):
+    """Switch ``client`` to streamed chat completions (see ``stream_chat_request``)."""
+    if not isinstance(client, RateLimitedClient):
+        client = RateLimitedClient(client)
+    client.request_fn = functools.partial(stream_chat_request, early_stop=early_stop)
+    return client
+
+
+def sampling_params(n=1):
+    """Sampling parameters of local-model requests; ``n`` > 1 samples that many completions per
+    prompt in one request, so the server prefills the prompt once."""
+    return {**SAMPLING_PARAMS, 'n': n} if n > 1 else dict(SAMPLING_PARAMS)
+
+
+def run_hf(client, data, messages, output_name, **kwargs):
+    model_name = kwargs['model_name']
+    concurrency = kwargs.get('concurrency', 16)
+    schedule = kwargs.get('schedule', 'fifo')
+    if kwargs.get('stream') or kwargs.get('early_stop'):
+        client = streaming_client(client, early_stop=kwargs.get('early_stop', False))
+
+    jobs, store = prepare_jobs(data, messages, output_name, ordered=schedule == 'fifo',
+                               lengths=kwargs.get('lengths'), max_model_len=kwargs.get('max_model_len', 0),
+                               min_output_tokens=kwargs.get('min_output_tokens', MIN_OUTPUT_TOKENS),
+                               tags=kwargs.get('tags') or {'model': model_name})
+    telemetry = open_telemetry(os.path.dirname(output_name), model_name)
+    try:
+        meter = asyncio.run(run_jobs(
+            client, jobs, concurrency=concurrency, schedule=schedule, telemetry=telemetry,
+            cache=kwargs.get('cache'),
             model=model_arg_dict[model_name],
-            messages=message,
-            temperature=0.6, top_p=0.95
-        )
-        generated = completion.choices[0].message.content
-        d['generated'] = generated
-        # output.append(d)
-        writer_.write(json.dumps(d) + '\n')
-        writer_.flush()
+            **sampling_params(kwargs.get('n', 1))
+        ))
+    finally:
+        telemetry.close()
+        store.close()
+    print(meter.summary())
+    print(meter.latency_report())
+    if isinstance(client, EndpointPool):
+        print(client.report())
 
-    # write_jsonl(output, output_name)
-    writer_.close()
+
+def make_client(args, base_url=None, **client_kwargs):
+    """AsyncOpenAI client wrapped with the engine's rate limiting, timeouts and retries.
+
+    A comma-separated ``base_url`` gives an ``EndpointPool`` that balances requests over the
+    servers and ejects unhealthy ones until their /health probe succeeds again.
+    """
+    # retries are handled by RateLimitedClient, so the SDK must not retry on its own
+    base_urls = base_url.split(',') if base_url else [None]
+    clients = [AsyncOpenAI(base_url=url, max_retries=0, **client_kwargs) for url in base_urls]
+    if len(clients) == 1:
+        return RateLimitedClient(clients[0], max_retries=args.max_retries, timeout=args.timeout)
+    return EndpointPool(clients, probe=probe_health, max_retries=args.max_retries, timeout=args.timeout)
 
 
 def main(args):
@@ -74,25 +170,44 @@ def main(args):
     )
     os.makedirs(args.results_dir, exist_ok=True)
     output_name = os.path.join(args.results_dir, f'{args.output_name}.jsonl')
+    tags = {'model': args.model_name, 'chain_type': args.chain_type, 'k': int(args.k),
+            'question_type': args.question_type}
 
-    if args.model_name in ['gpt-4o', 'gpt-4.1-2025-04-14', 'gpt-4o-2024-08-06', 'gpt-4.1-mini-2025-04-14']:
-        # batch
-        client = OpenAI(api_key=args.openai_apikey)
-        if args.tool:
-            print("\n\n ### Tool activated ### \n\n")
-            run_chat(client=client, data=data, messages=processed, output_name=output_name, model_name=args.model_name, tool=True)
+    cache = open_cache(args.results_dir, enabled=not args.no_cache)
+    try:
+        if args.model_name in BATCH_MODELS:
+            # batch
+            if args.tool:
+                print("\n\n ### Tool activated ### \n\n")
+                client = make_client(args, api_key=args.openai_apikey)
+                run_chat(client=client, data=data, messages=processed, output_name=output_name,
+                         model_name=args.model_name, tool=True, concurrency=args.concurrency, tags=tags, cache=cache,
+                         n=args.n_samples)
+            else:
+                client = OpenAI(api_key=args.openai_apikey)
+                processed = process_data(args.model_name, processed, n=args.n_samples)
+                run_batch(client=client, data=data, messages=processed, output_name=output_name,
+                          wait=args.batch_wait, poll_interval=args.poll_interval, cache=cache)
+        elif args.model_name in CHAT_MODELS:
+            client = make_client(args, api_key=args.openai_apikey)
+            run_chat(client=client, data=data, messages=processed, output_name=output_name, model_name=args.model_name,
+                     concurrency=args.concurrency, tags=tags, cache=cache, n=args.n_samples)
         else:
-            processed = process_data(args.model_name, processed)
-            run_batch(client=client, data=data, messages=processed, output_name=output_name)
-    elif args.model_name in ['o3', 'o3-mini', 'o3-2025-04-16', 'o3-mini-2025-01-31']:
-        client = OpenAI(api_key=args.openai_apikey)
-        run_chat(client=client, data=data, messages=processed, output_name=output_name, model_name=args.model_name)
-    else:
-        client = OpenAI(
-            base_url="http://localhost:8123/v1",
-            api_key="needlechain",
-        )
-        run_hf(client=client, data=data, messages=processed, output_name=output_name, model_name=args.model_name)
+            client = make_client(
+                args,
+                base_url=args.base_url,
+                api_key="needlechain",
+            )
+            lengths = None
+            if args.max_model_len or args.schedule in LENGTH_SCHEDULES:
+                lengths = token_lengths(args.model_name, args.k, args.val, args.chain_type, args.question_type)
+            run_hf(client=client, data=data, messages=processed, output_name=output_name, model_name=args.model_name,
+                   concurrency=args.concurrency, schedule=args.schedule,
+                   lengths=lengths, max_model_len=args.max_model_len, min_output_tokens=args.min_output_tokens,
+                   tags=tags, stream=args.stream, early_stop=args.early_stop, cache=cache, n=args.n_samples)
+    finally:
+        if cache is not None:
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -107,6 +222,33 @@ if __name__ == '__main__':
     parser.add_argument('--tool', default=False, action='store_true')
     parser.add_argument('--output_name', default='tmp', help="""d""")
     parser.add_argument('--results_dir', default='./results')
+    parser.add_argument('--concurrency', type=int, default=16, help='max in-flight requests')
+    parser.add_argument('--batch_wait', default=False, action='store_true',
+                        help='keep polling batch shards until all are done instead of checking once')
+    parser.add_argument('--poll_interval', type=float, default=60, help='seconds between batch status polls')
+    parser.add_argument('--timeout', type=float, default=600, help='per-request timeout in seconds')
+    parser.add_argument('--max_retries', type=int, default=8,
+                        help='retries for rate limits, timeouts and server errors (exponential backoff with jitter)')
+    parser.add_argument('--schedule', default='fifo', choices=SCHEDULES,
+                        help='request order; prefix groups prompts sharing a context for server prefix caching, '
+                             'longest/shortest/bucketed order by prompt length (token index or ~4 chars/token)')
+    parser.add_argument('--base_url', default=LOCAL_BASE_URL,
+                        help='OpenAI-compatible endpoint of the served model; comma-separate several replicas '
+                             'to balance requests over them')
+    parser.add_argument('--max_model_len', type=int, default=0,
+                        help='context length of the served model; with a token index, prompts that do not fit are '
+                             'skipped and max_tokens is set to the remaining context (0 = off)')
+    parser.add_argument('--min_output_tokens', type=int, default=MIN_OUTPUT_TOKENS,
+                        help='answer tokens a prompt must leave free to be sent')
+    parser.add_argument('--n_samples', type=int, default=1,
+                        help='completions sampled per prompt in one request (stored as a list per row, '
+                             'scored with majority vote and pass@k by evaluate.py)')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='neither read nor fill the response cache in <results_dir>/.cache')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream completions from the served model and record time to first token')
+    parser.add_argument('--early_stop', action='store_true',
+                        help='stream and cancel each generation once a complete "## Answer: <number>" line arrived')
 
     temporal_args = parser.parse_args()
     setproctitle.setproctitle(f'mmmm inference')
@@ -1,7 +1,9 @@
 import os
+import re
 import json
 import argparse
 import sys
+import time
 import subprocess
 import threading
 from pathlib import Path
@@ -42,63 +44,165 @@ class Colors:
     BG_GREEN = '\033[42m'
     BG_RED = '\033[41m'
 
-def colorize_vllm_log(line):
+# Log line classes in priority order: a line gets the first class any of its keywords belongs to.
+# One case-insensitive regex finds every keyword in a single pass over the line.
+LOG_CLASSES = [
+    ('error', Colors.BRIGHT_RED, ['error', 'failed', 'exception', 'traceback', 'out of memory',
+                                  'address already in use']),
+    ('warning', Colors.BRIGHT_YELLOW, ['warn']),
+    ('success', Colors.BRIGHT_GREEN, ['successfully', 'completed', 'ready', 'started', 'loaded',
+                                      'startup complete', 'uvicorn running']),
+    ('loading', Colors.BRIGHT_CYAN, ['loading', 'initializing', 'model']),
+    ('gpu', Colors.BRIGHT_MAGENTA, ['gpu', 'cuda', 'tensor']),
+    ('info', Colors.BLUE, ['info']),
+    ('debug', Colors.DIM, ['debug']),
+]
+LOG_CLASSIFIER = re.compile('|'.join(
+    f"(?P<{name}>{'|'.join(re.escape(keyword) for keyword in keywords)})" for name, _, keywords in LOG_CLASSES
+), re.IGNORECASE)
+LOG_PRIORITY = {name: priority for priority, (name, _, _) in enumerate(LOG_CLASSES)}
+LOG_COLORS = {name: color for name, color, _ in LOG_CLASSES}
+# lines of these classes are always shown; the rest can be sampled (see LogPipeline)
+IMPORTANT_LOG_CLASSES = {'error', 'warning', 'success'}
+
+def classify_vllm_log(line):
+    """Class of a log line (see LOG_CLASSES), or None if no keyword matches."""
+    best = None
+    for match in LOG_CLASSIFIER.finditer(line):
+        if best is None or LOG_PRIORITY[match.lastgroup] < LOG_PRIORITY[best]:
+            best = match.lastgroup
+            if best == 'error':
+                break
+    return best
+
+def colorize_vllm_log(line, log_class=None):
     """Apply colors to vLLM log lines based on content."""
     line = line.strip()
     if not line:
         return line
-    
-    # Error messages
-    if any(keyword in line.lower() for keyword in ['error', 'failed', 'exception', 'traceback']):
-        return f"{Colors.BRIGHT_RED}{line}{Colors.RESET}"
-    
-    # Warning messages
-    if any(keyword in line.lower() for keyword in ['warning', 'warn']):
-        return f"{Colors.BRIGHT_YELLOW}{line}{Colors.RESET}"
-    
-    # Success/completion messages
-    if any(keyword in line.lower() for keyword in ['successfully', 'completed', 'ready', 'started', 'loaded']):
-        return f"{Colors.BRIGHT_GREEN}{line}{Colors.RESET}"
-    
-    # Model loading info
-    if any(keyword in line.lower() for keyword in ['loading', 'initializing', 'model']):
-        return f"{Colors.BRIGHT_CYAN}{line}{Colors.RESET}"
-    
-    # GPU/CUDA info
-    if any(keyword in line.lower() for keyword in ['gpu', 'cuda', 'tensor']):
-        return f"{Colors.BRIGHT_MAGENTA}{line}{Colors.RESET}"
-    
-    # Info level messages
-    if 'info' in line.lower() or line.startswith('INFO'):
-        return f"{Colors.BLUE}{line}{Colors.RESET}"
-    
-    # Debug messages
-    if 'debug' in line.lower() or line.startswith('DEBUG'):
-        return f"{Colors.DIM}{line}{Colors.RESET}"
-    
-    # Default - slightly dimmed
-    return f"{Colors.WHITE}{line}{Colors.RESET}"
+    color = LOG_COLORS.get(log_class or classify_vllm_log(line), Colors.WHITE)
+    return f"{color}{line}{Colors.RESET}"
 
-def stream_process_output(process, prefix="[vLLM]"):
-    """Stream and colorize process output in real-time."""
-    def stream_stdout():
-        for line in iter(process.stdout.readline, b''):
-            line = line.decode('utf-8', errors='ignore').rstrip()
-            if line:
-                colored_line = colorize_vllm_log(line)
-                print(f"{Colors.BRIGHT_BLUE}{prefix}{Colors.RESET} {colored_line}")
+class RotatingLog:
+    """Append-only raw log file, rotated to ``.1`` ... ``.{backups}`` once it exceeds ``max_bytes``."""
+    
+    def __init__(self, filename, max_bytes=100 * 1024 ** 2, backups=3):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.file = open(filename, 'ab')
+        self.size = self.file.tell()
+    
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.rotate()
+    
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.filename}.{i}"):
+                os.replace(f"{self.filename}.{i}", f"{self.filename}.{i + 1}")
+        if self.backups:
+            os.replace(self.filename, f"{self.filename}.1")
+        self.file = open(self.filename, 'wb')
+        self.size = 0
+    
+    def flush(self):
+        self.file.flush()
+    
+    def close(self):
+        self.file.close()
+
+class LogPipeline:
+    """Console and raw-log output of one process, written in batches.
+
+    Reader threads only classify and queue lines; a flusher thread writes the queue every
+    ``flush_interval`` seconds. With ``sample=N`` the console shows every N-th routine line but
+    all errors, warnings and success lines; ``log_file`` gets every raw line.
+    """
+    
+    def __init__(self, prefix, log_file=None, sample=1, flush_interval=0.2, max_pending=1000):
+        self.prefix = prefix
+        self.sample = max(sample, 1)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.raw = RotatingLog(log_file) if log_file else None
+        self.console = []
+        self.pending_raw = []
+        self.routine = 0
+        self.lock = threading.Lock()
+        # held from taking a batch until it is written, so batches reach stdout and the raw log in order
+        self.write_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+    
+    def add(self, line, raw, stderr=False):
+        log_class = classify_vllm_log(line)
+        show = log_class in IMPORTANT_LOG_CLASSES
+        with self.lock:
+            if not show:
+                self.routine += 1
+                show = self.routine % self.sample == 0
+            if show:
+                tag = f"{Colors.BRIGHT_RED}{self.prefix}[ERR]" if stderr else f"{Colors.BRIGHT_BLUE}{self.prefix}"
+                self.console.append(f"{tag}{Colors.RESET} {colorize_vllm_log(line, log_class)}\n")
+            if self.raw is not None:
+                self.pending_raw.append(raw)
+            full = len(self.console) + len(self.pending_raw) >= self.max_pending
+        if full:
+            self.flush()
+    
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                console, self.console = self.console, []
+                pending_raw, self.pending_raw = self.pending_raw, []
+            if console:
+                sys.stdout.write(''.join(console))
                 sys.stdout.flush()
-    
-    def stream_stderr():
-        for line in iter(process.stderr.readline, b''):
-            line = line.decode('utf-8', errors='ignore').rstrip()
+            if pending_raw:
+                self.raw.write(b''.join(pending_raw))
+                self.raw.flush()
+    
+    def _flush_loop(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+    
+    def close(self):
+        self.closed.set()
+        # a flush still running on the flusher thread must finish before the raw log is closed
+        self.flusher.join()
+        self.flush()
+        if self.raw is not None:
+            self.raw.close()
+
+def stream_process_output(process, prefix="[vLLM]", on_line=None, log_file=None, sample=1, flush_interval=0.2):
+    """Stream and colorize process output through a ``LogPipeline``.
+
+    ``on_line(line)`` is called with every raw stdout/stderr line, e.g. to watch for readiness.
+    """
+    pipeline = LogPipeline(prefix, log_file=log_file, sample=sample, flush_interval=flush_interval)
+    remaining = [2]
+    
+    def stream(pipe, stderr):
+        for raw in pipe:
+            line = raw.decode('utf-8', errors='ignore').rstrip()
             if line:
-                colored_line = colorize_vllm_log(line)
-                print(f"{Colors.BRIGHT_RED}{prefix}[ERR]{Colors.RESET} {colored_line}")
-                sys.stdout.flush()
-    
-    stdout_thread = threading.Thread(target=stream_stdout)
-    stderr_thread = threading.Thread(target=stream_stderr)
+                if on_line:
+                    on_line(line)
+                pipeline.add(line, raw, stderr)
+        with pipeline.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            pipeline.close()
+    
+    stdout_thread = threading.Thread(target=stream, args=(process.stdout, False))
+    stderr_thread = threading.Thread(target=stream, args=(process.stderr, True))
     
     stdout_thread.daemon = True
     stderr_thread.daemon = True
@@ -108,7 +212,7 @@ def stream_process_output(process, prefix="[vLLM]"):
     
     return stdout_thread, stderr_thread
 
-def execute_vllm_command(cmd):
+def execute_vllm_command(cmd, log_file=None, log_sample=1):
     """Execute vLLM command with real-time colored output streaming."""
     print(f"\n{Colors.BG_BLUE}{Colors.WHITE} Starting vLLM Server {Colors.RESET}")
     print(f"{Colors.BRIGHT_BLUE}Command:{Colors.RESET} {cmd}")
@@ -125,7 +229,7 @@ def execute_vllm_command(cmd):
     )
     
     # Start streaming threads
-    stdout_thread, stderr_thread = stream_process_output(process)
+    stdout_thread, stderr_thread = stream_process_output(process, log_file=log_file, sample=log_sample)
     
     try:
         # Wait for process to complete
@@ -153,6 +257,57 @@ def execute_vllm_command(cmd):
         print(f"{Colors.BRIGHT_YELLOW}Server stopped.{Colors.RESET}")
         return False
 
+def replica_gpu_groups(gpu_devices, tensor_parallel_size=1, replicas=1):
+    """Split the comma-separated ``gpu_devices`` into ``replicas`` disjoint groups of ``tensor_parallel_size``."""
+    devices = [d.strip() for d in str(gpu_devices).split(',') if d.strip()]
+    needed = tensor_parallel_size * replicas
+    if len(devices) < needed:
+        raise ValueError(f"{replicas} replicas x tensor_parallel_size {tensor_parallel_size} need {needed} GPUs, "
+                         f"got {len(devices)} ({gpu_devices})")
+    return [','.join(devices[i * tensor_parallel_size:(i + 1) * tensor_parallel_size]) for i in range(replicas)]
+
+def replica_log_file(log_file, port):
+    root, ext = os.path.splitext(log_file)
+    return f"{root}.{port}{ext}"
+
+def execute_vllm_replicas(cmds, ports, log_file=None, log_sample=1):
+    """Run one vLLM server per command side by side until all have exited; Ctrl-C stops all of them."""
+    print(f"\n{Colors.BG_BLUE}{Colors.WHITE} Starting {len(cmds)} vLLM Servers {Colors.RESET}")
+    processes = []
+    for cmd, port in zip(cmds, ports):
+        print(f"{Colors.BRIGHT_BLUE}Command (port {port}):{Colors.RESET} {cmd}")
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   bufsize=1, universal_newlines=False)
+        stream_process_output(process, prefix=f"[vLLM:{port}]", sample=log_sample,
+                              log_file=replica_log_file(log_file, port) if log_file else None)
+        processes.append(process)
+    print(f"{Colors.BRIGHT_BLUE}{'='*60}{Colors.RESET}")
+
+    def stop_all():
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+    try:
+        # a replica that dies is ejected by the runner's endpoint pool, so the others keep serving
+        while any(process.poll() is None for process in processes):
+            time.sleep(1)
+        failed = [port for process, port in zip(processes, ports) if process.returncode != 0]
+        if failed:
+            print(f"\n{Colors.BG_RED}{Colors.WHITE} vLLM Server(s) on port {', '.join(map(str, failed))} failed {Colors.RESET}\n")
+        return not failed
+    except KeyboardInterrupt:
+        print(f"\n{Colors.BRIGHT_YELLOW}Stopping {len(processes)} vLLM servers...{Colors.RESET}")
+        stop_all()
+        print(f"{Colors.BRIGHT_YELLOW}Servers stopped.{Colors.RESET}")
+        return False
+
 def load_model_config(model_path):
     """Load model configuration to check for rope_scaling settings."""
     config_path = Path(model_path) / "config.json"
@@ -162,10 +317,84 @@ def load_model_config(model_path):
         return config.get('rope_scaling', None)
     return None
 
+def read_model_config(model_path):
+    """Load the full config.json of a local model (empty dict if missing)."""
+    config_path = Path(model_path) / "config.json"
+    if config_path.exists():
+        with open(config_path, 'r') as f:
+            return json.load(f)
+    return {}
+
+def detect_gpu_memory_gb(gpu_devices="0"):
+    """Return the smallest total memory (GiB) among the selected GPUs, or None if unknown."""
+    try:
+        output = subprocess.run(
+            ['nvidia-smi', '--query-gpu=index,memory.total', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, timeout=10
+        ).stdout
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None
+    wanted = {d.strip() for d in str(gpu_devices).split(',') if d.strip()}
+    sizes = []
+    for line in output.strip().splitlines():
+        # skips driver error messages printed to stdout and "[N/A]" memory values
+        parts = [part.strip() for part in line.split(',')]
+        if len(parts) != 2:
+            continue
+        index, memory = parts
+        try:
+            memory = float(memory)
+        except ValueError:
+            continue
+        if not wanted or index in wanted:
+            sizes.append(memory / 1024)
+    return min(sizes) if sizes else None
+
+def throughput_profile(model_config, max_model_len=None, tensor_parallel_size=1,
+                       gpu_memory_gb=None, gpu_memory_utilization=0.90):
+    """Pick continuous-batching settings from config.json and the requested context length.
+
+    The KV-cache budget is whatever is left of the GPU memory fraction after the fp16 weights;
+    max_num_seqs is sized so that the budget holds that many half-full context windows.
+    """
+    model_config = model_config.get('text_config', model_config)  # multimodal configs nest the LM
+    context_len = max_model_len or model_config.get('max_position_embeddings') or 8192
+    hidden = model_config.get('hidden_size', 4096)
+    layers = model_config.get('num_hidden_layers', 32)
+    heads = model_config.get('num_attention_heads', 32)
+    kv_heads = model_config.get('num_key_value_heads', heads)
+    head_dim = model_config.get('head_dim') or hidden // heads
+    intermediate = model_config.get('intermediate_size', 4 * hidden)
+    vocab = model_config.get('vocab_size', 32000)
+
+    num_params = layers * (2 * hidden * hidden + 2 * hidden * kv_heads * head_dim + 3 * hidden * intermediate) \
+        + 2 * vocab * hidden
+    weight_gb = num_params * 2 / tensor_parallel_size / 1024 ** 3
+    kv_bytes_per_token = 2 * layers * kv_heads * head_dim * 2 / tensor_parallel_size
+
+    gpu_memory_gb = gpu_memory_gb or 48.0
+    kv_budget_gb = max(gpu_memory_gb * gpu_memory_utilization - weight_gb - 2.0, 0.0)
+    kv_tokens = kv_budget_gb * 1024 ** 3 / kv_bytes_per_token
+    max_num_seqs = int(max(1, min(256, kv_tokens // max(context_len // 2, 1))))
+
+    return {
+        'max_num_seqs': max_num_seqs,
+        'max_num_batched_tokens': int(max(2048, min(context_len, 16384))),
+        'enable_prefix_caching': True,
+        'gpu_memory_utilization': gpu_memory_utilization,
+        'kv_cache_tokens': int(kv_tokens),
+        'context_len': int(context_len),
+    }
+
 def build_vllm_command(model_path, port=8123, rope_scaling=None, max_model_len=None, 
                       tensor_parallel_size=1, api_key="needlechain", gpu_devices="0",
-                      attention_backend=None, disable_flashinfer_sampling=False):
-    """Build vLLM serving command with proper rope_scaling configuration."""
+                      attention_backend=None, disable_flashinfer_sampling=False,
+                      profile='latency', enable_prefix_caching=False):
+    """Build vLLM serving command with proper rope_scaling configuration.
+
+    ``profile='latency'`` serves one sequence at a time; ``profile='throughput'`` enables
+    continuous batching with settings from ``throughput_profile``.
+    """
     
     # Load config from model if rope_scaling not provided
     if rope_scaling is None:
@@ -190,8 +419,28 @@ def build_vllm_command(model_path, port=8123, rope_scaling=None, max_model_len=N
         f"--api-key {api_key}",
         "--dtype auto",
         f"--tensor-parallel-size {tensor_parallel_size}",
-        "--max_num_seqs 1"
     ]
+
+    if profile == 'throughput':
+        settings = throughput_profile(
+            read_model_config(model_path),
+            max_model_len=max_model_len,
+            tensor_parallel_size=tensor_parallel_size,
+            gpu_memory_gb=detect_gpu_memory_gb(gpu_devices),
+        )
+        print(f"{Colors.BRIGHT_GREEN}Throughput profile:{Colors.RESET} "
+              + ", ".join(f"{key}={value}" for key, value in settings.items()))
+        cmd_parts.extend([
+            f"--max_num_seqs {settings['max_num_seqs']}",
+            f"--max-num-batched-tokens {settings['max_num_batched_tokens']}",
+            f"--gpu-memory-utilization {settings['gpu_memory_utilization']}",
+        ])
+        enable_prefix_caching = enable_prefix_caching or settings['enable_prefix_caching']
+    else:
+        cmd_parts.append("--max_num_seqs 1")
+
+    if enable_prefix_caching:
+        cmd_parts.append("--enable-prefix-caching")
     
     # Add rope_scaling if specified
     if rope_scaling:
@@ -245,6 +494,8 @@ def main():
     parser.add_argument('--port', type=int, default=8123, help='Port to serve on')
     parser.add_argument('--api_key', default='needlechain', help='API key for the server')
     parser.add_argument('--tensor_parallel_size', type=int, default=1, help='Number of GPUs to use')
+    parser.add_argument('--replicas', type=int, default=1,
+                        help='Independent servers on disjoint --gpu_devices groups, on ports --port, --port+1, ...')
     parser.add_argument('--max_model_len', type=int, help='Maximum model context length')
     parser.add_argument('--gpu_devices', default='0', help='CUDA device IDs (comma-separated)')
     parser.add_argument('--rope_scaling', help='Rope scaling configuration (JSON string or file path)')
@@ -254,6 +505,14 @@ def main():
                        help='vLLM attention backend (helps with FlashInfer issues)')
     parser.add_argument('--disable_flashinfer_sampling', action='store_true',
                        help='Disable FlashInfer sampling (use for CUDA compatibility issues)')
+    parser.add_argument('--profile', default='latency', choices=['latency', 'throughput'],
+                       help='latency: one sequence at a time; throughput: continuous batching sized from config.json')
+    parser.add_argument('--enable_prefix_caching', action='store_true',
+                       help='Reuse KV cache across prompts sharing a prefix (always on with --profile throughput)')
+    parser.add_argument('--log_file', default=None,
+                        help='Tee the raw server output to this file (rotated at 100 MB; one file per replica)')
+    parser.add_argument('--log_sample', type=int, default=1,
+                        help='Show every N-th routine log line on the console (errors, warnings and milestones always)')
     parser.add_argument('--dry_run', action='store_true', help='Print command without executing')
     
     args = parser.parse_args()
@@ -280,32 +539,50 @@ def main():
         print(f"Auto-detected chat template: {chat_template}")
     
     if args.framework == 'vllm':
-        cmd = build_vllm_command(
-            model_path=args.model_path,
-            port=args.port,
-            rope_scaling=rope_scaling,
-            max_model_len=args.max_model_len,
-            tensor_parallel_size=args.tensor_parallel_size,
-            api_key=args.api_key,
-            gpu_devices=args.gpu_devices,
-            attention_backend=args.attention_backend,
-            disable_flashinfer_sampling=args.disable_flashinfer_sampling
-        )
+        try:
+            gpu_groups = replica_gpu_groups(args.gpu_devices, args.tensor_parallel_size, args.replicas)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        ports = [args.port + i for i in range(args.replicas)]
+        cmds = []
+        for port, gpu_devices in zip(ports, gpu_groups if args.replicas > 1 else [args.gpu_devices]):
+            cmd = build_vllm_command(
+                model_path=args.model_path,
+                port=port,
+                rope_scaling=rope_scaling,
+                max_model_len=args.max_model_len,
+                tensor_parallel_size=args.tensor_parallel_size,
+                api_key=args.api_key,
+                gpu_devices=gpu_devices,
+                attention_backend=args.attention_backend,
+                disable_flashinfer_sampling=args.disable_flashinfer_sampling,
+                profile=args.profile,
+                enable_prefix_caching=args.enable_prefix_caching
+            )
+            
+            if chat_template and os.path.exists(chat_template):
+                cmd += f" \\\n        --chat-template {chat_template}"
+            cmds.append(cmd)
         
-        if chat_template and os.path.exists(chat_template):
-            cmd += f" \\\n        --chat-template {chat_template}"
+        if args.replicas > 1:
+            base_urls = ','.join(f"http://localhost:{port}/v1" for port in ports)
+            print(f"{Colors.BRIGHT_GREEN}Replicas:{Colors.RESET} pass --base_url {base_urls} to the runner")
         
         if args.dry_run:
             print("="*60)
             print("Starting local model server with command:")
             print("="*60)
-            print(cmd)
+            print("\n\n".join(cmds))
             print("="*60)
             print("Dry run mode - command not executed")
             return
         
         # Execute the command with colored output streaming
-        success = execute_vllm_command(cmd)
+        if args.replicas > 1:
+            success = execute_vllm_replicas(cmds, ports, args.log_file, args.log_sample)
+        else:
+            success = execute_vllm_command(cmds[0], args.log_file, args.log_sample)
         if not success:
             sys.exit(1)
     
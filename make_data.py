@@ -1,5 +1,9 @@
 from utils import *
 
+import shutil
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 
@@ -127,22 +131,243 @@ def prepare_chain(idx, k=10, val=1600):
     }
 
 
+STEP_CHAINS = ['decrease', 'same', 'increase']  # log2 step -1 / 0 / +1
+PARALLEL_EXPONENTS = (-3, 4)  # x0.125 ... x8
+VALUE_BOUND = 6  # forward values stay within [val/64, val*64]
+
+
+def fold_walk(walk, bound=VALUE_BOUND):
+    """Reflect an unbounded integer walk into [-bound, bound]."""
+    period = 4 * bound
+    return bound - np.abs((walk + bound) % period - 2 * bound)
+
+
+def row_rng(seed, idx):
+    """Independent stream for row ``idx``: child ``idx`` of ``SeedSequence(seed)``."""
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(idx,)))
+
+
+def draw_chains(n, k=10, rng=None, seed=None, start_idx=0):
+    """Draw the integer description of n rows at once.
+
+    Returns name indices into NAMES, forward log2 levels (a reflected random walk built from
+    x0.5/x1/x2 steps, so no row ever has to be rejected), parallel log2 multipliers, and the
+    orders used by the parallel and chaotic chains.
+
+    With ``seed`` every row draws from its own ``row_rng`` stream, so row i is identical no
+    matter how the rows are split into batches or workers; otherwise the whole batch draws
+    from ``rng``.
+    """
+    if seed is not None:
+        draws = []
+        for idx in range(start_idx, start_idx + n):
+            row = row_rng(seed, idx)
+            draws.append((
+                row.permutation(len(NAMES))[:k],
+                row.integers(-1, 2, size=k),
+                row.integers(*PARALLEL_EXPONENTS, size=k),
+                row.permutation(k),
+                row.permutation(k),
+            ))
+        names, steps, exponents, parallel_order, chaotic_order = (np.stack(a) for a in zip(*draws))
+    else:
+        rng = np.random.default_rng() if rng is None else rng
+        all_names = np.tile(np.arange(len(NAMES), dtype=np.int16), (n, 1))
+        names = rng.permuted(all_names, axis=1)[:, :k]
+        steps = rng.integers(-1, 2, size=(n, k), dtype=np.int16)
+        exponents = rng.integers(*PARALLEL_EXPONENTS, size=(n, k), dtype=np.int8)
+        order = np.tile(np.arange(k, dtype=np.int16), (n, 1))
+        parallel_order = rng.permuted(order, axis=1)
+        chaotic_order = rng.permuted(order, axis=1)
+
+    steps[:, 0] = 0
+    levels = fold_walk(np.cumsum(steps, axis=1)).astype(np.int8)
+    return {
+        'names': names,
+        'levels': levels,
+        'exponents': exponents.astype(np.int8),
+        'parallel_order': parallel_order,
+        'chaotic_order': chaotic_order,
+    }
+
+
+RELATIONS = np.array([CHAINS[c].replace('{p1}', '').replace('{p2}.', '') for c in STEP_CHAINS], dtype=object)
+
+
+def join_sentences(parts, order=None):
+    """Join an (n, k, m) object array of sentence pieces into one newline-separated chain per row.
+
+    Sentences are only reordered and joined, never concatenated element-wise, so the cost is one
+    ``str.join`` per row.
+    """
+    n = parts.shape[0]
+    if order is not None:
+        parts = parts[np.arange(n)[:, None], order]
+    parts = np.concatenate([parts, np.full(parts.shape[:2] + (1,), '\n', dtype=object)], axis=2)
+    return [''.join(row)[:-1] for row in parts.reshape(n, -1).tolist()]
+
+
+def render_rows(chains, val=1600, start_idx=0):
+    """Turn ``draw_chains`` output into the JSONL records written by ``prepare_chain``.
+
+    Values and totals are computed for the whole batch; needle sentences are assembled from
+    object arrays of name/relation pieces and joined once per row.
+    """
+    names = np.array(NAMES, dtype=object)[chains['names']]
+    levels = chains['levels']
+    n, k = names.shape
+
+    exponents = np.arange(*PARALLEL_EXPONENTS)
+    parallel_text = np.array([f' received ${val * 2.0 ** e} last week.' for e in exponents], dtype=object)
+    parallel_vals = val * np.exp2(chains['exponents'].astype(np.float64))
+    parallel_parts = np.stack([names, parallel_text[chains['exponents'] - exponents[0]]], axis=2)
+
+    forward_vals = val * np.exp2(levels.astype(np.float64))
+    forward_parts = np.empty((n, k, 4), dtype=object)
+    forward_parts[:, :, 0] = names
+    forward_parts[:, 0, 1:] = [f' received ${val} last week.', '', '']
+    forward_parts[:, 1:, 1] = RELATIONS[np.diff(levels.astype(np.int16), axis=1) + 1]
+    forward_parts[:, 1:, 2] = names[:, :-1]
+    forward_parts[:, 1:, 3] = '.'
+
+    parallel_chains = join_sentences(parallel_parts, chains['parallel_order'])
+    forward_chains = join_sentences(forward_parts)
+    backward_chains = join_sentences(forward_parts[:, ::-1])
+    chaotic_chains = join_sentences(forward_parts, chains['chaotic_order'])
+    parallel_totals = parallel_vals.sum(axis=1).tolist()
+    forward_totals = forward_vals.sum(axis=1).tolist()
+    parallel_last = parallel_vals[:, -1].tolist()
+    forward_last = forward_vals[:, -1].tolist()
+    names = names.tolist()
+
+    data = []
+    for i in range(n):
+        data.append({
+            'idx': start_idx + i,
+            'names': ', '.join(names[i]),
+            'parallel_chain': parallel_chains[i],
+            'parallel_total_val': parallel_totals[i],
+            'parallel_lastname': names[i][-1],
+            'parallel_single_val': parallel_last[i],
+            'forward_chain': forward_chains[i],
+            'forward_total_val': forward_totals[i],
+            'forward_lastname': names[i][-1],
+            'forward_single_val': forward_last[i],
+            'backward_chain': backward_chains[i],
+            'backward_total_val': forward_totals[i],
+            'backward_lastname': names[i][-1],
+            'backward_single_val': forward_last[i],
+            'chaotic_chain': chaotic_chains[i],
+            'chaotic_total_val': forward_totals[i],
+            'chaotic_lastname': names[i][-1],
+            'chaotic_single_val': forward_last[i],
+        })
+    return data
+
+
+def prepare_chains(n, k=10, val=1600, rng=None, start_idx=0, seed=None):
+    """Batched counterpart of ``prepare_chain``: n rows drawn as whole arrays, then rendered."""
+    return render_rows(draw_chains(n, k, rng, seed, start_idx), val=val, start_idx=start_idx)
+
+
+CHAIN_DTYPES = {
+    'names': np.int16,
+    'levels': np.int8,
+    'exponents': np.int8,
+    'parallel_order': np.int16,
+    'chaotic_order': np.int16,
+}
+
+
+def save_chains(chains, val, filename):
+    """Store ``draw_chains`` output as a compressed .npz instead of pre-rendered text."""
+    arrays = {key: np.asarray(chains[key], dtype=dtype) for key, dtype in CHAIN_DTYPES.items()}
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, val=np.int64(val), **arrays)
+
+
+class ChainDataset:
+    """Rows of a .npz dataset, rendered to the JSONL record format on every iteration."""
+
+    def __init__(self, filename, batch_size=256):
+        with np.load(filename) as f:
+            self.val = int(f['val'])
+            self.chains = {key: f[key] for key in CHAIN_DTYPES}
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.chains['names'])
+
+    def __iter__(self):
+        for start in range(0, len(self), self.batch_size):
+            batch = {key: value[start:start + self.batch_size] for key, value in self.chains.items()}
+            yield from render_rows(batch, val=self.val, start_idx=start)
+
+
+def draw_shard(start_idx, n, k, seed):
+    return draw_chains(n, k, seed=seed, start_idx=start_idx)
+
+
+def shard_path(save_filename, start_idx):
+    return f'{save_filename}.{start_idx:09d}.part'
+
+
+def write_shard(save_filename, start_idx, n, k, val, seed):
+    """Generate rows [start_idx, start_idx + n) into a part file next to ``save_filename``."""
+    shard_filename = shard_path(save_filename, start_idx)
+    write_jsonl(prepare_chains(n, k, val, start_idx=start_idx, seed=seed), shard_filename)
+    return shard_filename
+
+
 def main(args):
     results_dir = args.results_dir
     k = args.k
     n = args.n
     val = args.val
-    save_filename = os.path.join(results_dir, f'k{k}---val{val}.jsonl')
-    data = []
+    save_filename = os.path.join(results_dir, f'k{k}---val{val}.{args.format}')
+    seed = args.seed if args.seed is not None else np.random.SeedSequence().entropy
+    print(f"seed: {seed}")
 
-    for i in range(n):
-        chain = None
-        while chain is None:
-            # print(f'retry {i}')
-            chain = prepare_chain(i, k, val)
-        data.append(chain)
+    shards = [(start, min(args.shard_size, n - start)) for start in range(0, n, args.shard_size)]
+    if args.format == 'npz':
+        if args.workers > 1:
+            with ProcessPoolExecutor(args.workers) as pool:
+                draws = list(pool.map(draw_shard, *zip(*[(start, size, k, seed) for start, size in shards])))
+        else:
+            draws = [draw_shard(start, size, k, seed) for start, size in shards]
+        chains = {key: np.concatenate([d[key] for d in draws]) for key in CHAIN_DTYPES}
+        save_chains(chains, val, save_filename)
+        print(f"data saved: {save_filename}")
+        return
 
-    write_jsonl(data, save_filename)
+    complete = False
+    try:
+        with (ProcessPoolExecutor(args.workers) if args.workers > 1 else nullcontext()) as pool:
+            if pool is not None:
+                futures = [pool.submit(write_shard, save_filename, start, size, k, val, seed) for start, size in shards]
+                parts = (future.result() for future in futures)
+            else:
+                futures = []
+                parts = (write_shard(save_filename, start, size, k, val, seed) for start, size in shards)
+            try:
+                # shards are merged in idx order, so the file does not depend on --workers
+                with open(save_filename, 'wb') as f:
+                    for part in parts:
+                        with open(part, 'rb') as shard:
+                            shutil.copyfileobj(shard, f)
+                        os.remove(part)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        complete = True
+    finally:
+        # after a failed shard: the parts already written and the truncated output
+        for start, _ in shards:
+            if os.path.exists(shard_path(save_filename, start)):
+                os.remove(shard_path(save_filename, start))
+        if not complete and os.path.exists(save_filename):
+            os.remove(save_filename)
     print(f"data saved: {save_filename}")
 
 if __name__ == '__main__':
@@ -152,6 +377,11 @@ if __name__ == '__main__':
     parser.add_argument('--n', type=int, default=200, help='number of chain for each dataset')
     parser.add_argument('--val', type=int, default=1600, help='detail of needle')
     parser.add_argument('--results_dir', default='./data', help='data save path')
+    parser.add_argument('--seed', type=int, default=None, help='dataset seed (printed when not given)')
+    parser.add_argument('--workers', type=int, default=1, help='number of generator processes')
+    parser.add_argument('--shard_size', type=int, default=1000, help='rows per generator task')
+    parser.add_argument('--format', default='jsonl', choices=['jsonl', 'npz'],
+                        help='jsonl: rendered chains; npz: compact integer arrays rendered at load time')
     args = parser.parse_args()
 
     main(args)
@@ -0,0 +1,420 @@
+"""
+Mock OpenAI-compatible server for exercising the harness without a GPU.
+Answers are solved from the prompt's salary chain, so a run against it scores 100% unless
+wrong answers are injected. Latency, token rate, errors and rate limits are configurable.
+
+Usage:
+    python mock_server.py --port 8123 --latency lognormal:-1.5,0.5 --tokens_per_second 200 --error_rate 0.05
+"""
+
+import re
+import time
+import json
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FACT_PATTERNS = [
+    (re.compile(r'^(.+?) received \$([\d.]+) last week\.$'), None),
+    (re.compile(r'^(.+?) earns twice as much as (.+?)\.$'), 2.0),
+    (re.compile(r'^(.+?) earns half as much as (.+?)\.$'), 0.5),
+    (re.compile(r'^(.+?) earns the same salary as (.+?)\.$'), 1.0),
+]
+SINGLE_QUESTION = re.compile(r'How much salary did (.+?) get\?')
+FILLER = 'Following the salary facts one step at a time. '
+
+
+def solve_salaries(text):
+    """Resolve every salary stated or implied by the facts in ``text``."""
+    values, relations = {}, []
+    for line in text.splitlines():
+        line = line.strip()
+        for pattern, ratio in FACT_PATTERNS:
+            match = pattern.match(line)
+            if match is None:
+                continue
+            if ratio is None:
+                values[match.group(1)] = float(match.group(2))
+            else:
+                relations.append((match.group(1), match.group(2), ratio))
+            break
+    # propagate along relations in both directions until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for p1, p2, ratio in relations:
+            if p2 in values and p1 not in values:
+                values[p1] = values[p2] * ratio
+                changed = True
+            elif p1 in values and p2 not in values:
+                values[p2] = values[p1] / ratio
+                changed = True
+    return values
+
+
+def format_number(value):
+    return str(int(value)) if float(value).is_integer() else f'{value:g}'
+
+
+def solve_prompt(messages):
+    """Return the chain's answer to the question in the last user message, or None."""
+    text = messages[-1]['content'] if messages else ''
+    values = solve_salaries(text)
+    if not values:
+        return None
+    match = SINGLE_QUESTION.search(text)
+    if match:
+        return values.get(match.group(1))
+    return sum(values.values())
+
+
+def parse_latency(spec):
+    """Parse ``fixed:S``, ``uniform:A,B``, ``exp:MEAN`` or ``lognormal:MU,SIGMA`` into a sampler."""
+    kind, _, params = spec.partition(':')
+    params = [float(p) for p in params.split(',') if p]
+    samplers = {
+        'fixed': lambda rng: params[0],
+        'uniform': lambda rng: rng.uniform(params[0], params[1]),
+        'exp': lambda rng: rng.expovariate(1 / params[0]) if params[0] > 0 else 0.0,
+        'lognormal': lambda rng: rng.lognormvariate(params[0], params[1]),
+    }
+    if kind not in samplers:
+        raise ValueError(f'unknown latency distribution: {spec}')
+    return samplers[kind]
+
+
+class MockState:
+    """Behaviour settings plus the in-memory files and batches shared by all handler threads."""
+
+    def __init__(self, latency='fixed:0', tokens_per_second=0, output_tokens=64, error_rate=0.0,
+                 error_codes=(429, 500, 503), wrong_rate=0.0, rpm=0, batch_delay=0.0, seed=0,
+                 prefill_tokens_per_second=0, tail_tokens=0):
+        self.sample_latency = parse_latency(latency)
+        self.tokens_per_second = tokens_per_second
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.output_tokens = output_tokens
+        self.tail_tokens = tail_tokens
+        self.error_rate = error_rate
+        self.error_codes = list(error_codes)
+        self.wrong_rate = wrong_rate
+        self.rpm = rpm
+        self.batch_delay = batch_delay
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.files = {}
+        self.batches = {}
+        self.requests = 0
+        self.cancelled = 0
+
+    def draw(self):
+        with self.lock:
+            self.requests += 1
+            return self.sample_latency(self.rng), self.rng.random()
+
+    def rate_limit(self):
+        """Record a request in the one-minute window; return (headers, seconds until a slot frees)."""
+        if not self.rpm:
+            return {}, 0.0
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - self.recent[0] >= 60:
+                self.recent.popleft()
+            wait = 60 - (now - self.recent[0]) if len(self.recent) >= self.rpm else 0.0
+            if not wait:
+                self.recent.append(now)
+            remaining = self.rpm - len(self.recent)
+        headers = {'x-ratelimit-limit-requests': str(self.rpm), 'x-ratelimit-remaining-requests': str(remaining)}
+        return headers, wait
+
+    def answer_text(self, body):
+        """Completion text for ``body`` and its (prompt tokens, completion tokens)."""
+        messages = body.get('messages', [])
+        answer = solve_prompt(messages)
+        digest = hashlib.sha1(json.dumps(messages, sort_keys=True).encode('utf-8')).digest()
+        if answer is not None and int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.wrong_rate:
+            answer += 1
+        text = FILLER * max(0, self.output_tokens // 8) + (
+            f"## Answer: {format_number(answer)}" if answer is not None else "I cannot find the answer."
+        ) + '\n' + FILLER * max(0, self.tail_tokens // 8)
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages) // 4
+        return text, prompt_tokens, max(1, len(text) // 4)
+
+    def completion(self, body, stream_delay=True):
+        """Build a chat.completion for ``body``; sleeps for the simulated decode time.
+
+        ``n`` > 1 returns that many (identical) choices, decoded side by side like a batched server.
+        """
+        text, prompt_tokens, completion_tokens = self.answer_text(body)
+        n = body.get('n') or 1
+        if stream_delay and self.prefill_tokens_per_second:
+            time.sleep(prompt_tokens / self.prefill_tokens_per_second)
+        if stream_delay and self.tokens_per_second:
+            time.sleep(completion_tokens / self.tokens_per_second)
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', 'mock'),
+            'choices': [{
+                'index': index,
+                'finish_reason': 'stop',
+                'message': {'role': 'assistant', 'content': text},
+            } for index in range(n)],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': n * completion_tokens,
+                'total_tokens': prompt_tokens + n * completion_tokens,
+            },
+        }
+
+    def completion_chunks(self, body):
+        """Yield chat.completion.chunk dicts of about 4 characters each, paced like ``completion``.
+
+        A trailing usage chunk follows when ``stream_options.include_usage`` is set.
+        """
+        text, prompt_tokens, completion_tokens = self.answer_text(body)
+        base = {'id': f'chatcmpl-{uuid.uuid4().hex}', 'object': 'chat.completion.chunk',
+                'created': int(time.time()), 'model': body.get('model', 'mock')}
+        if self.prefill_tokens_per_second:
+            time.sleep(prompt_tokens / self.prefill_tokens_per_second)
+        n = body.get('n') or 1
+        for start in range(0, len(text), 4):
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            for index in range(n):
+                yield {**base, 'choices': [{'index': index, 'delta': {'content': text[start:start + 4]},
+                                            'finish_reason': None}]}
+        for index in range(n):
+            yield {**base, 'choices': [{'index': index, 'delta': {}, 'finish_reason': 'stop'}]}
+        if (body.get('stream_options') or {}).get('include_usage'):
+            yield {**base, 'choices': [], 'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': n * completion_tokens,
+                'total_tokens': prompt_tokens + n * completion_tokens,
+            }}
+
+    def add_file(self, content, filename, purpose):
+        file_id = f'file-{uuid.uuid4().hex[:24]}'
+        self.files[file_id] = {
+            'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+            'filename': filename, 'purpose': purpose, 'status': 'processed', 'content': content,
+        }
+        return file_id
+
+    def batch_status(self, batch):
+        """Finish a batch once ``batch_delay`` has passed, writing its output file."""
+        if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= self.batch_delay:
+            lines = self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+            outputs = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                outputs.append(json.dumps({
+                    'id': f'batch_req_{uuid.uuid4().hex[:24]}',
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'request_id': uuid.uuid4().hex,
+                                 'body': self.completion(request['body'], stream_delay=False)},
+                    'error': None,
+                }))
+            content = ('\n'.join(outputs) + '\n').encode('utf-8')
+            batch['output_file_id'] = self.add_file(content, f"{batch['id']}_output.jsonl", 'batch_output')
+            batch['status'] = 'completed'
+            batch['completed_at'] = int(time.time())
+            batch['request_counts'] = {'total': len(outputs), 'completed': len(outputs), 'failed': 0}
+        return batch
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, obj, status=200, headers=None):
+        data = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json({'error': {'message': message, 'type': 'mock_error', 'code': status}}, status, headers)
+
+    def read_body(self):
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/health':
+            self.send_json({'status': 'ok'})
+        elif path == '/v1/models':
+            self.send_json({'object': 'list', 'data': [{'id': 'mock', 'object': 'model', 'created': 0, 'owned_by': 'mock'}]})
+        elif path.startswith('/v1/files/'):
+            file_id, _, rest = path[len('/v1/files/'):].partition('/')
+            item = self.state.files.get(file_id)
+            if item is None:
+                self.send_error_json(404, f'no such file: {file_id}')
+            elif rest == 'content':
+                self.send_response(200)
+                self.send_header('content-type', 'application/octet-stream')
+                self.send_header('content-length', str(len(item['content'])))
+                self.end_headers()
+                self.wfile.write(item['content'])
+            else:
+                self.send_json({k: v for k, v in item.items() if k != 'content'})
+        elif path.startswith('/v1/batches/'):
+            batch = self.state.batches.get(path[len('/v1/batches/'):])
+            if batch is None:
+                self.send_error_json(404, 'no such batch')
+            else:
+                self.send_json(self.state.batch_status(batch))
+        else:
+            self.send_error_json(404, f'unknown path: {path}')
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        body = self.read_body()
+        if path == '/v1/chat/completions':
+            self.chat_completions(json.loads(body))
+        elif path == '/v1/files':
+            self.upload_file(body)
+        elif path == '/v1/batches':
+            self.create_batch(json.loads(body))
+        elif path.startswith('/v1/batches/') and path.endswith('/cancel'):
+            batch = self.state.batches.get(path[len('/v1/batches/'):-len('/cancel')])
+            if batch is None:
+                self.send_error_json(404, 'no such batch')
+            else:
+                batch['status'] = 'cancelled'
+                self.send_json(batch)
+        else:
+            self.send_error_json(404, f'unknown path: {path}')
+
+    def chat_completions(self, body):
+        headers, wait = self.state.rate_limit()
+        if wait:
+            self.send_error_json(429, 'rate limit reached', {**headers, 'retry-after': f'{wait:.3f}'})
+            return
+        latency, roll = self.state.draw()
+        time.sleep(latency)
+        if roll < self.state.error_rate:
+            status = self.state.error_codes[int(roll / self.state.error_rate * len(self.state.error_codes))]
+            extra = {'retry-after': '0.1'} if status == 429 else {}
+            self.send_error_json(status, 'injected error', {**headers, **extra})
+            return
+        if body.get('stream'):
+            self.send_stream(self.state.completion_chunks(body), headers)
+        else:
+            self.send_json(self.state.completion(body), headers=headers)
+
+    def send_stream(self, chunks, headers=None):
+        """Send ``chunks`` as server-sent events; a client that hangs up early ends the stream."""
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.send_header('connection', 'close')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for chunk in chunks:
+                self.wfile.write(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.state.cancelled += 1
+
+    def upload_file(self, body):
+        message = BytesParser(policy=HTTP).parsebytes(
+            b'content-type: ' + self.headers['content-type'].encode('latin-1') + b'\r\n\r\n' + body
+        )
+        fields, content, filename = {}, b'', 'upload.jsonl'
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if name == 'file':
+                content = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            else:
+                fields[name] = part.get_payload(decode=True).decode('utf-8')
+        file_id = self.state.add_file(content, filename, fields.get('purpose', 'batch'))
+        self.send_json({k: v for k, v in self.state.files[file_id].items() if k != 'content'})
+
+    def create_batch(self, body):
+        if body.get('input_file_id') not in self.state.files:
+            self.send_error_json(400, 'unknown input_file_id')
+            return
+        batch_id = f'batch_{uuid.uuid4().hex[:24]}'
+        self.state.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint', '/v1/chat/completions'),
+            'input_file_id': body['input_file_id'], 'completion_window': body.get('completion_window', '24h'),
+            'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None,
+            'error_file_id': None, 'metadata': body.get('metadata'),
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+        }
+        self.send_json(self.state.batches[batch_id])
+
+
+def serve(host='127.0.0.1', port=0, **kwargs):
+    """Start the mock server in a daemon thread and return it; ``server.server_port`` is the bound port."""
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock OpenAI-compatible server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--latency', default='fixed:0',
+                        help='per-request latency: fixed:S, uniform:A,B, exp:MEAN or lognormal:MU,SIGMA (seconds)')
+    parser.add_argument('--tokens_per_second', type=float, default=0, help='simulated decode speed (0 = instant)')
+    parser.add_argument('--prefill_tokens_per_second', type=float, default=0,
+                        help='simulated prefill speed, so long prompts take longer (0 = instant)')
+    parser.add_argument('--output_tokens', type=int, default=64, help='approximate completion length')
+    parser.add_argument('--tail_tokens', type=int, default=0,
+                        help='approximate tokens of text after the answer line (for testing early stop)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests answered with an error')
+    parser.add_argument('--error_codes', default='429,500,503', help='comma-separated status codes to inject')
+    parser.add_argument('--wrong_rate', type=float, default=0.0, help='fraction of prompts answered incorrectly')
+    parser.add_argument('--rpm', type=int, default=0, help='requests per minute before answering 429 (0 = unlimited)')
+    parser.add_argument('--batch_delay', type=float, default=0.0, help='seconds before a batch completes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(
+        latency=args.latency, tokens_per_second=args.tokens_per_second, output_tokens=args.output_tokens,
+        prefill_tokens_per_second=args.prefill_tokens_per_second, tail_tokens=args.tail_tokens,
+        error_rate=args.error_rate, error_codes=[int(c) for c in args.error_codes.split(',')],
+        wrong_rate=args.wrong_rate, rpm=args.rpm, batch_delay=args.batch_delay, seed=args.seed,
+    )
+    print(f'mock server listening on http://{args.host}:{server.server_port}/v1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
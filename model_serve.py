@@ -9,10 +9,36 @@ setproctitle("mmmm")
 parser = argparse.ArgumentParser()
 parser.add_argument('--model_name', default='qwen2.5-32B')
 parser.add_argument('--framework', default='vllm', choices=['vllm', 'sglang'])
+parser.add_argument('--profile', default='latency', choices=['latency', 'throughput'])
+parser.add_argument('--enable_prefix_caching', action='store_true')
 args = parser.parse_args()
 
 model = model_arg_dict[args.model_name]
 
+
+def batching_flags(model, max_model_len=32768, tensor_parallel_size=4, gpu_devices='4,5,6,7'):
+    if args.profile != 'throughput':
+        return '--max_num_seqs 1' + (' --enable-prefix-caching' if args.enable_prefix_caching else '')
+    from local_model_serve import read_model_config, detect_gpu_memory_gb, throughput_profile
+
+    config = read_model_config(model)
+    if not config:
+        try:
+            from transformers import AutoConfig
+            config = AutoConfig.from_pretrained(model).to_dict()
+        except Exception:
+            config = {}
+    settings = throughput_profile(
+        config, max_model_len=max_model_len, tensor_parallel_size=tensor_parallel_size,
+        gpu_memory_gb=detect_gpu_memory_gb(gpu_devices),
+    )
+    print('throughput profile: ' + ', '.join(f'{key}={value}' for key, value in settings.items()))
+    return (f"--max_num_seqs {settings['max_num_seqs']} "
+            f"--max-num-batched-tokens {settings['max_num_batched_tokens']} "
+            f"--gpu-memory-utilization {settings['gpu_memory_utilization']} "
+            f"--enable-prefix-caching")
+
+
 if __name__ == '__main__':
     if args.framework == 'vllm':
         chat_template = chat_template_dict[args.model_name]
@@ -24,7 +50,7 @@ if __name__ == '__main__':
         --dtype auto \
         --max_model_len 32768 \
         --tensor-parallel-size 4 \
-        --max_num_seqs 1 \
+        {batching_flags(model)} \
         --chat-template {chat_template}""")
     #     --max_model_len 32768 \  # gemma에서는 없이
     elif args.framework == 'sglang':
@@ -48,7 +74,6 @@ if __name__ == '__main__':
         wait_for_server(f"http://localhost:{port}")
         print(f"Server started on http://localhost:{port}")
 
-# enable_prefix_caching=True
 
 # nohup python model_serve.py --model_name qwen2.5-3B > logs/model &
 # nohup python model_serve.py --model_name qwen2.5-7B-int4 > logs/model &
@@ -0,0 +1,616 @@
+"""
+Asynchronous request engine for OpenAI-compatible endpoints.
+Keeps many chat completions in flight and writes results back in submission order.
+"""
+
+import re
+import time
+import random
+import asyncio
+import itertools
+from types import SimpleNamespace
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+from response_cache import request_key
+
+try:
+    from openai import APIError, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+    RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, InternalServerError, RateLimitError)
+    # failures of one request: the row is skipped and retried by the next run
+    REQUEST_ERRORS = RETRYABLE_ERRORS + (APIError,)
+except ImportError:
+    RateLimitError = None
+    RETRYABLE_ERRORS = ()
+    REQUEST_ERRORS = ()
+
+try:
+    # a connection dropped while a stream is read is raised by httpx, not wrapped by the SDK
+    from httpx import TransportError
+    REQUEST_ERRORS += (TransportError,)
+except ImportError:
+    pass
+
+
+class OrderedWriter:
+    """Pass finished rows to a ``ResultStore``, in submission order when ``ordered`` is set.
+
+    Out-of-order rows wait in memory until every earlier position is done; with
+    ``ordered=False`` each row is stored as soon as it completes.
+    """
+
+    def __init__(self, store, ordered=True):
+        self.store = store
+        self.ordered = ordered
+        self.pending = {}
+        self.next_pos = 0
+
+    def put(self, pos, entry):
+        if not self.ordered:
+            if entry is not None:
+                self.store.write(entry)
+            return
+        self.pending[pos] = entry
+        while self.next_pos in self.pending:
+            entry = self.pending.pop(self.next_pos)
+            if entry is not None:
+                self.store.write(entry)
+            self.next_pos += 1
+
+    def skip(self, pos):
+        """Release a position whose request failed, so later rows are not held back."""
+        self.put(pos, None)
+
+
+def usage_tokens(usage):
+    """(prompt tokens, completion tokens) of a response ``usage``, None where not reported."""
+    if usage is None:
+        return None, None
+    # chat completions report prompt/completion tokens, the responses API input/output tokens
+    prompt_tokens = getattr(usage, 'prompt_tokens', None)
+    completion_tokens = getattr(usage, 'completion_tokens', None)
+    if prompt_tokens is None:
+        prompt_tokens = getattr(usage, 'input_tokens', None)
+    if completion_tokens is None:
+        completion_tokens = getattr(usage, 'output_tokens', None)
+    return prompt_tokens, completion_tokens
+
+
+class ThroughputMeter:
+    """Count finished requests and tokens to report requests/sec and tokens/sec, and keep
+    request latencies per prompt-length bucket."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.failures = 0
+        self.cached = 0
+        self.latencies = defaultdict(list)
+
+    def update(self, usage, latency=None, bucket=None):
+        self.requests += 1
+        if latency is not None:
+            self.latencies[bucket].append(latency)
+        prompt_tokens, completion_tokens = usage_tokens(usage)
+        self.prompt_tokens += prompt_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    def summary(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (
+            f"{self.requests} requests in {elapsed:.1f}s ({self.failures} failed, {self.cached} from cache) | "
+            f"{self.requests / elapsed:.2f} req/s | "
+            f"{self.prompt_tokens / elapsed:.1f} prompt tok/s | "
+            f"{self.completion_tokens / elapsed:.1f} completion tok/s"
+        )
+
+    def latency_report(self):
+        lines = []
+        for bucket in sorted(self.latencies, key=lambda b: (b is None, b)):
+            p50, p95, p99 = np.percentile(self.latencies[bucket], [50, 95, 99])
+            label = f'<={bucket} tok' if bucket is not None else 'all'
+            lines.append(f"{label:>12}: n={len(self.latencies[bucket])} "
+                         f"p50={p50:.2f}s p95={p95:.2f}s p99={p99:.2f}s")
+        return '\n'.join(lines)
+
+
+def parse_duration(value):
+    """Parse rate-limit reset values such as '1s', '6m0s', '20ms' or '0.5' into seconds."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+class TokenBucket:
+    """Async token bucket; unlimited until a limit is learned from response headers."""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.rate = None
+        self.capacity = None
+        self.level = 0.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def sync(self, limit, remaining):
+        """Adopt the server's view: ``limit`` per window with ``remaining`` left right now."""
+        self._refill()
+        self.capacity = float(limit)
+        self.rate = self.capacity / self.window
+        self.level = min(self.level, float(remaining)) if self.level else float(remaining)
+
+    async def acquire(self, cost=1.0):
+        while True:
+            self._refill()
+            if self.rate is None:
+                return
+            cost = min(cost, self.capacity)
+            if self.level >= cost:
+                self.level -= cost
+                return
+            await asyncio.sleep((cost - self.level) / self.rate)
+
+
+class RateLimiter:
+    """Request and token buckets driven by x-ratelimit-* headers, plus a shared pause after a 429."""
+
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.tokens = TokenBucket()
+        self.paused_until = 0.0
+
+    def update(self, headers):
+        if not headers:
+            return
+        for bucket, name in [(self.requests, 'requests'), (self.tokens, 'tokens')]:
+            limit = headers.get(f'x-ratelimit-limit-{name}')
+            remaining = headers.get(f'x-ratelimit-remaining-{name}')
+            if limit is not None and remaining is not None:
+                try:
+                    bucket.sync(float(limit), float(remaining))
+                except ValueError:
+                    pass
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, tokens):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+
+def combined_finish_reason(reasons):
+    # with n > 1 samples, report a length stop if any sample hit max_tokens
+    return 'length' if 'length' in reasons else reasons[0]
+
+
+async def chat_request(client, message, stats=None, **params):
+    """One chat completion; with ``n`` > 1 the text is the list of the n sampled completions."""
+    raw = await client.chat.completions.with_raw_response.create(messages=message, **params)
+    completion = raw.parse()
+    choices = sorted(completion.choices, key=lambda choice: choice.index)
+    finish_reason = combined_finish_reason([choice.finish_reason for choice in choices])
+    if params.get('n', 1) > 1:
+        return [choice.message.content for choice in choices], completion.usage, raw.headers, finish_reason
+    return choices[0].message.content, completion.usage, raw.headers, finish_reason
+
+
+async def responses_request(client, message, stats=None, **params):
+    # system prompt as instructions, user prompt as input (used with tools such as code_interpreter)
+    raw = await client.responses.with_raw_response.create(
+        instructions=message[0]['content'], input=message[1]['content'], **params
+    )
+    response = raw.parse()
+    # the responses API has no finish_reason; an incomplete response says why it stopped
+    details = getattr(response, 'incomplete_details', None)
+    finish_reason = getattr(details, 'reason', None) if details else response.status
+    return response.output_text, response.usage, raw.headers, finish_reason
+
+
+# a complete final-answer line as scored by evaluate.py; checked once its newline has arrived
+ANSWER_LINE = re.compile(r'## Answer:[^\d\n]*\d')
+
+
+class AnswerWatcher:
+    """Watch streamed text line by line for a ``## Answer: <number>`` line outside <think>."""
+
+    def __init__(self):
+        self.line = ''
+        self.offset = 0  # characters fed before ``self.line``
+        self.thinking = False
+
+    def feed(self, delta):
+        """Add a chunk of text; once a complete answer line has been seen, return the offset
+        just past its newline (the end of the answer in all text fed so far), else None."""
+        self.line += delta
+        if '\n' not in delta:
+            return None
+        *lines, self.line = self.line.split('\n')
+        for line in lines:
+            self.offset += len(line) + 1
+            if line.rfind('</think>') > line.rfind('<think>'):
+                self.thinking = False
+            elif '<think>' in line:
+                self.thinking = True
+            if not self.thinking and ANSWER_LINE.search(line):
+                return self.offset
+        return None
+
+
+async def stream_chat_request(client, message, stats=None, early_stop=False, **params):
+    """Chat completion consumed as a stream of SSE chunks.
+
+    Records the seconds until the first content or reasoning token as ``stats['ttft']``. With
+    ``early_stop`` the stream is closed as soon as every sample has sent a complete
+    ``## Answer: <number>`` line, which makes the server abort the generation; the
+    finish_reason is then ``answer`` and the completion tokens are counted from the received
+    chunks. With ``n`` > 1 the text is the list of the n sampled completions.
+    """
+    n = params.get('n', 1)
+    start = time.perf_counter()
+    stream = await client.chat.completions.create(
+        messages=message, stream=True, stream_options={'include_usage': True}, **params
+    )
+    parts = [[] for _ in range(n)]
+    reasons = [None] * n
+    watchers = [AnswerWatcher() for _ in range(n)] if early_stop else None
+    answered = {}  # sample index -> end of its answer line
+    chunks, usage, stopped = 0, None, False
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                reasons[choice.index] = choice.finish_reason or reasons[choice.index]
+                delta = choice.delta
+                content = delta.content if delta is not None else None
+                if content or getattr(delta, 'reasoning_content', None):
+                    chunks += 1
+                    if stats is not None and stats.get('ttft') is None:
+                        stats['ttft'] = time.perf_counter() - start
+                if content:
+                    parts[choice.index].append(content)
+                    if watchers is not None and choice.index not in answered:
+                        end = watchers[choice.index].feed(content)
+                        if end is not None:
+                            answered[choice.index] = end
+            if watchers is not None and len(answered) == n:
+                stopped = True
+                break
+    finally:
+        await stream.close()
+    if usage is None:
+        usage = SimpleNamespace(prompt_tokens=None, completion_tokens=chunks)
+    texts = [''.join(sample) for sample in parts]
+    if stopped:
+        # drop what arrived after the answer line in its chunk; it would run into the number once
+        # evaluate.py removes the newlines
+        texts = [text[:answered[index]] for index, text in enumerate(texts)]
+    finish_reason = 'answer' if stopped else combined_finish_reason(reasons)
+    return (texts if n > 1 else texts[0]), usage, stream.response.headers, finish_reason
+
+
+class RateLimitedClient:
+    """Wrap an ``AsyncOpenAI`` client with rate limiting, per-request timeouts and retries.
+
+    Retryable failures (429, timeouts, connection errors, 5xx) are retried with exponential
+    backoff and full jitter, honouring ``retry-after`` when the server sends it. Build the
+    wrapped client with ``max_retries=0`` so the SDK does not retry underneath.
+    """
+
+    def __init__(self, client, request_fn=chat_request, limiter=None, max_retries=8, timeout=600.0,
+                 base_delay=1.0, max_delay=60.0):
+        self.client = client
+        self.request_fn = request_fn
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt, headers=None):
+        retry_after = parse_duration(headers.get('retry-after')) if headers else None
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retry_delay(self, attempt, error):
+        return self.backoff(attempt, response_headers(error))
+
+    async def close(self):
+        await self.client.close()
+
+    async def _send(self, client, limiter, message, estimate, stats, **params):
+        """One try through ``client``, keeping ``limiter`` in sync with the response headers."""
+        start = time.perf_counter()
+        await limiter.acquire(estimate)
+        stats['wait'] += time.perf_counter() - start
+        stats['attempts'] += 1
+        try:
+            text, usage, headers, finish_reason = await self.request_fn(client, message, stats=stats,
+                                                                        timeout=self.timeout, **params)
+        except RETRYABLE_ERRORS as e:
+            headers = response_headers(e)
+            limiter.update(headers)
+            if isinstance(e, RateLimitError):
+                retry_after = parse_duration(headers.get('retry-after')) if headers else None
+                limiter.pause(retry_after if retry_after is not None else self.base_delay)
+            raise
+        limiter.update(headers)
+        stats['finish_reason'] = finish_reason
+        return text, usage
+
+    async def _attempt(self, message, estimate, stats, **params):
+        return await self._send(self.client, self.limiter, message, estimate, stats, **params)
+
+    async def complete(self, message, stats=None, **params):
+        """Return (text, usage) for one request, retrying retryable errors.
+
+        ``stats``, if given, is a dict that receives the number of ``attempts``, the seconds
+        spent waiting for the rate limiter and retry backoff (``wait``), the ``finish_reason``
+        and, from streaming request functions, the time to first token (``ttft``).
+        """
+        stats = {} if stats is None else stats
+        stats.update(attempts=0, wait=0.0, finish_reason=None, ttft=None)
+        estimate = sum(len(m['content']) for m in message) / 4
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._attempt(message, estimate, stats, **params)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt, e)
+                stats['wait'] += delay
+                await asyncio.sleep(delay)
+
+
+def response_headers(error):
+    return getattr(getattr(error, 'response', None), 'headers', None)
+
+
+class Endpoint:
+    """One server behind an ``EndpointPool`` with its own rate limiter and health state."""
+
+    def __init__(self, client):
+        self.client = client
+        self.limiter = RateLimiter()
+        self.outstanding = 0
+        self.failures = 0
+        self.served = 0
+        self.ejected = False
+        base_url = str(client.base_url).rstrip('/')
+        self.base_url = base_url
+        self.health_url = base_url[:-len('/v1')] + '/health' if base_url.endswith('/v1') else base_url + '/health'
+
+
+class EndpointPool(RateLimitedClient):
+    """A ``RateLimitedClient`` over several OpenAI-compatible endpoints serving the same model.
+
+    Each request goes to the live endpoint with the fewest outstanding requests. After
+    ``eject_after`` consecutive failures (timeouts, connection errors, 5xx) an endpoint is
+    ejected and only taken back once ``probe(health_url)`` returns True, checked every
+    ``probe_interval`` seconds (without a probe it is taken back after one interval).
+    """
+
+    def __init__(self, clients, probe=None, eject_after=3, probe_interval=5.0, **kwargs):
+        super().__init__(None, **kwargs)
+        self.endpoints = [Endpoint(client) for client in clients]
+        self.probe = probe
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self._probes = set()
+
+    async def close(self):
+        for task in list(self._probes):
+            task.cancel()
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    def _pick(self):
+        live = [endpoint for endpoint in self.endpoints if not endpoint.ejected]
+        # with every endpoint ejected, keep trying the least-failed one rather than stalling
+        return min(live or self.endpoints, key=lambda endpoint: (endpoint.outstanding, endpoint.failures))
+
+    async def _attempt(self, message, estimate, stats, **params):
+        endpoint = self._pick()
+        endpoint.outstanding += 1
+        try:
+            result = await self._send(endpoint.client, endpoint.limiter, message, estimate, stats, **params)
+        except RETRYABLE_ERRORS as e:
+            if not isinstance(e, RateLimitError):
+                self._record_failure(endpoint)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        endpoint.failures = 0
+        endpoint.served += 1
+        return result
+
+    def _record_failure(self, endpoint):
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_after and not endpoint.ejected:
+            endpoint.ejected = True
+            tqdm.write(f'ejecting {endpoint.base_url} after {endpoint.failures} consecutive failures')
+            task = asyncio.get_running_loop().create_task(self._readmit(endpoint))
+            self._probes.add(task)
+            task.add_done_callback(self._probes.discard)
+
+    async def _readmit(self, endpoint):
+        while endpoint.ejected:
+            await asyncio.sleep(self.probe_interval)
+            if self.probe is None or await asyncio.to_thread(self.probe, endpoint.health_url):
+                endpoint.ejected = False
+                endpoint.failures = 0
+                tqdm.write(f'{endpoint.base_url} is healthy again')
+
+    def report(self):
+        return '\n'.join(
+            f"{endpoint.base_url}: {endpoint.served} requests" + (' (ejected)' if endpoint.ejected else '')
+            for endpoint in self.endpoints
+        )
+
+
+LENGTH_SCHEDULES = ['longest', 'shortest', 'bucketed']
+SCHEDULES = ['fifo', 'prefix'] + LENGTH_SCHEDULES
+
+
+def estimate_tokens(job):
+    """Prompt tokens of a job: from the token index when known, else about 4 characters per token."""
+    if job.get('tokens') is not None:
+        return job['tokens']
+    return sum(len(m['content']) for m in job['message']) // 4
+
+
+def length_bucket(tokens, smallest=1024):
+    """Power-of-two upper bound of ``tokens`` (at least ``smallest``), used as the bucket label."""
+    bucket = smallest
+    while bucket < tokens:
+        bucket *= 2
+    return bucket
+
+
+def _prefix_key(job):
+    # Prompts end with the question line; everything before it is shared by the question types
+    *head, last = job['message']
+    return tuple(m['content'] for m in head) + (last['content'].rsplit('\n', 1)[0],)
+
+
+def schedule_jobs(jobs, schedule='fifo'):
+    """Split jobs into groups that are dispatched in order; jobs inside a group run back to back.
+
+    ``fifo`` keeps the submission order with one job per group. ``prefix`` sorts prompts so that
+    the longest shared prefixes are adjacent and groups prompts that differ only in the question,
+    so the server prefills the shared context once and serves the rest from its prefix cache.
+    ``longest`` and ``shortest`` order by estimated prompt tokens; ``bucketed`` sends power-of-two
+    length buckets one after another (longest bucket first, submission order inside a bucket) so
+    requests batched together on the server have similar lengths.
+    """
+    if schedule == 'prefix':
+        ordered = sorted(jobs, key=lambda job: [m['content'] for m in job['message']])
+        return [list(group) for _, group in itertools.groupby(ordered, key=_prefix_key)]
+    if schedule == 'fifo':
+        return [[job] for job in jobs]
+    if schedule in ('longest', 'shortest'):
+        return [[job] for job in sorted(jobs, key=estimate_tokens, reverse=schedule == 'longest')]
+    if schedule == 'bucketed':
+        return [[job] for job in sorted(jobs, key=lambda job: -length_bucket(estimate_tokens(job)))]
+    raise ValueError(f'unknown schedule: {schedule}')
+
+
+def telemetry_record(job, stats, start, latency, usage=None, error=None):
+    """One telemetry row: the job's ``tags``, client-side timers and the response usage."""
+    prompt_tokens, completion_tokens = usage_tokens(usage)
+    return {
+        **job.get('tags', {}),
+        'idx': job['entry'].get('idx'),
+        'start': start,
+        'latency': latency,
+        'wait': stats.get('wait'),
+        'ttft': stats.get('ttft'),
+        'attempts': stats.get('attempts'),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'finish_reason': stats.get('finish_reason'),
+        'error': error,
+    }
+
+
+async def _worker(client, groups, meter, pbar, params, telemetry=None, cache=None):
+    for group in groups:
+        for job in group:
+            stats = {}
+            started_at = time.time()
+            start = time.perf_counter()
+            try:
+                text, usage = await client.complete(job['message'], stats=stats, **params, **job.get('params', {}))
+            except REQUEST_ERRORS as e:
+                # the row stays out of the result file, so the next run retries it
+                meter.failures += 1
+                job['sink'].skip(job['pos'])
+                if telemetry is not None:
+                    telemetry.write(telemetry_record(job, stats, started_at, time.perf_counter() - start,
+                                                     error=type(e).__name__))
+                tqdm.write(f"request failed for idx {job['entry'].get('idx')}: {type(e).__name__}: {e}")
+                pbar.update(1)
+                continue
+            latency = time.perf_counter() - start
+            job['entry']['generated'] = text
+            job['sink'].put(job['pos'], job['entry'])
+            meter.update(usage, latency, length_bucket(estimate_tokens(job)))
+            if telemetry is not None:
+                telemetry.write(telemetry_record(job, stats, started_at, latency, usage))
+            # an early-stopped response is not what the same request returns in full
+            if cache is not None and stats.get('finish_reason') != 'answer':
+                cache.put(job['cache_key'], params.get('model'), text, *usage_tokens(usage),
+                          stats.get('finish_reason'))
+            pbar.update(1)
+
+
+def serve_from_cache(jobs, cache, params, meter):
+    """Answer the jobs whose request is in ``cache`` and return the ones still to send.
+
+    Each job gets its ``cache_key`` from its messages and request parameters.
+    """
+    remaining = []
+    for job in jobs:
+        job['cache_key'] = request_key(job['message'], {**params, **job.get('params', {})})
+        hit = cache.get(job['cache_key'], samples=params.get('n', 1) > 1)
+        if hit is None:
+            remaining.append(job)
+            continue
+        job['entry']['generated'] = hit[0]
+        job['sink'].put(job['pos'], job['entry'])
+        meter.cached += 1
+    return remaining
+
+
+async def run_jobs(client, jobs, concurrency=16, schedule='fifo', telemetry=None, cache=None, **params):
+    """Send every job through ``client`` with at most ``concurrency`` requests in flight.
+
+    ``client`` is a ``RateLimitedClient`` (or ``EndpointPool``) or a bare ``AsyncOpenAI`` client
+    (wrapped with the defaults). A job is a dict with ``message`` (chat messages), ``entry``
+    (the data row that receives ``generated``), ``sink`` (an ``OrderedWriter``) and ``pos``
+    (the job's position in that sink), plus optional per-request ``params`` such as
+    ``max_tokens``, and ``tags`` copied into its telemetry row. Jobs are started in the order
+    given by ``schedule_jobs``. With ``telemetry`` (anything with ``write(row)``, such as a
+    ``JsonlWriter``) every request, failed ones included, is recorded by ``telemetry_record``.
+    With a ``ResponseCache`` as ``cache``, requests answered before are served from it without
+    being sent, and new responses are added to it.
+    The client is closed when the run ends, since its connections belong to this event loop.
+    Returns the ``ThroughputMeter`` of the run.
+    """
+    if not isinstance(client, RateLimitedClient):
+        client = RateLimitedClient(client)
+    meter = ThroughputMeter()
+    if cache is not None:
+        jobs = serve_from_cache(jobs, cache, params, meter)
+    groups = schedule_jobs(jobs, schedule)
+    groups_iter = iter(groups)
+    with tqdm(total=len(jobs)) as pbar:
+        workers = [
+            _worker(client, groups_iter, meter, pbar, params, telemetry, cache)
+            for _ in range(max(1, min(concurrency, len(groups))))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await client.close()
+    return meter
@@ -0,0 +1,99 @@
+"""
+Content-addressed cache of model responses shared by every inference path.
+
+A response is keyed by the SHA-256 of the request's messages and parameters (model id,
+sampling params, max_tokens, tools, ...), so an identical request is answered from the cache
+whatever output file, run or process asked for it first. The cache is one SQLite file in WAL
+mode under ``<results_dir>/.cache``, safe to share between concurrent runs.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    text TEXT NOT NULL,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    finish_reason TEXT,
+    created REAL
+)
+'''
+
+
+def cache_path(results_dir):
+    return os.path.join(results_dir, '.cache', 'responses.sqlite')
+
+
+def request_key(messages, params):
+    """Hex digest identifying a request; ``params`` must include the model."""
+    # stdlib json with sorted keys, so the key does not depend on the JSON backend or dict order
+    payload = json.dumps([messages, params], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """SQLite store of ``request_key`` -> (text, prompt tokens, completion tokens, finish_reason).
+
+    ``put`` commits every ``commit_every`` rows and on ``close``; a crash loses at most that
+    many responses, which the next run requests again.
+    """
+
+    def __init__(self, filename, commit_every=32):
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.commit_every = commit_every
+        self.pending = 0
+        # the batch watcher thread uses the cache while the main thread waits for it
+        self.db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, key, samples=False):
+        """Return (text, prompt tokens, completion tokens, finish_reason), or None on a miss.
+
+        With ``samples`` the text is the list of completions of an ``n`` > 1 request.
+        """
+        row = self.db.execute(
+            'SELECT text, prompt_tokens, completion_tokens, finish_reason FROM responses WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None and samples:
+            row = (json.loads(row[0]),) + row[1:]
+        return row
+
+    def put(self, key, model, text, prompt_tokens=None, completion_tokens=None, finish_reason=None):
+        if text is None:
+            return
+        if isinstance(text, list):
+            # the n completions of a multi-sample request; n is part of the key
+            text = json.dumps(text, ensure_ascii=False)
+        self.db.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (key, model, text, prompt_tokens, completion_tokens, finish_reason, time.time()),
+        )
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+def open_cache(results_dir, enabled=True):
+    """The shared response cache of ``results_dir``, or None when caching is disabled."""
+    return ResponseCache(cache_path(results_dir)) if enabled else None
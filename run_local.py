@@ -5,6 +5,7 @@ Handles model serving and inference automatically.
 """
 
 import os
+import re
 import json
 import time
 import argparse
@@ -15,11 +16,8 @@ import threading
 from pathlib import Path
 from multiprocessing import Process
 
-try:
-    import requests
-except ImportError:
-    print("Warning: requests not available, server health checking disabled")
-    requests = None
+import server_pool
+from utils import probe_health
 
 try:
     from openai import OpenAI
@@ -46,42 +44,84 @@ except ImportError:
     def colorize_vllm_log(line):
         return line
     
-    def stream_process_output(process, prefix="[vLLM]"):
+    def stream_process_output(process, prefix="[vLLM]", on_line=None):
         return None, None
 
-def check_server_health(port=8123, max_retries=60, retry_delay=3):
-    """Check if the model server is healthy and ready."""
-    if not requests:
-        print(f"{Colors.BRIGHT_YELLOW}Warning: requests not available, skipping health check{Colors.RESET}")
-        time.sleep(10)  # Give some time for server to start
-        return True
+# vLLM's API server logs these once it accepts requests / when startup cannot succeed
+READY_LOG_PATTERN = re.compile(r'Application startup complete|Uvicorn running on')
+FATAL_LOG_PATTERN = re.compile(r'CUDA out of memory|OutOfMemoryError|Engine core initialization failed|'
+                               r'EngineDeadError|Address already in use|No available memory for the cache blocks')
+
+class ReadinessWatcher:
+    """Watches server log lines (``on_line``) for the startup marker or a fatal error."""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.ready = False
+        self.fatal = None
     
+    def on_line(self, line):
+        if self.event.is_set():
+            return
+        if FATAL_LOG_PATTERN.search(line):
+            self.fatal = line
+            self.event.set()
+        elif READY_LOG_PATTERN.search(line):
+            self.ready = True
+            self.event.set()
+
+def check_server_health(port=8123, timeout=600, process=None, watcher=None, max_delay=2.0):
+    """Wait until the server on ``port`` is ready.
+
+    With a ``watcher`` fed from the server's log stream this returns as soon as vLLM logs its
+    startup marker, and fails as soon as it logs a fatal error; ``process`` exiting fails at once
+    too. /health is polled with exponential backoff (up to ``max_delay`` seconds) in the meantime,
+    which is all there is to go on for a server without a log stream.
+    """
     url = f"http://localhost:{port}/health"
     
     print(f"\n{Colors.BRIGHT_BLUE}Checking server health...{Colors.RESET}")
     
-    for i in range(max_retries):
-        try:
-            response = requests.get(url, timeout=5)
-            if response.status_code == 200:
-                print(f"{Colors.BRIGHT_GREEN}✓ Server is healthy and ready on port {port}{Colors.RESET}")
-                return True
-        except (requests.exceptions.RequestException, requests.exceptions.Timeout):
-            pass
+    start = time.time()
+    delay = 0.25
+    marker_handled = False  # the watcher's event stays set, so it may only cut one sleep short
+    while True:
+        if watcher is not None and watcher.fatal:
+            print(f"\n{Colors.BRIGHT_RED}✗ Server failed to start: {watcher.fatal}{Colors.RESET}")
+            return False
+        if process is not None and process.poll() is not None:
+            print(f"\n{Colors.BRIGHT_RED}✗ Server exited during startup (exit code: {process.returncode}){Colors.RESET}")
+            return False
+        if probe_health(url):
+            print(f"{Colors.BRIGHT_GREEN}✓ Server is healthy and ready on port {port} "
+                  f"({time.time() - start:.1f}s){Colors.RESET}")
+            return True
         
-        # Show progress with dots
-        dots = "." * (i % 4)
-        print(f"{Colors.BRIGHT_BLUE}Waiting for server to be ready{dots:<3} ({i+1}/{max_retries}){Colors.RESET}", end='\r')
-        time.sleep(retry_delay)
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            break
+        print(f"{Colors.BRIGHT_BLUE}Waiting for server to be ready ({elapsed:.0f}/{timeout:.0f}s){Colors.RESET}", end='\r')
+        # sleep until the next probe, waking up early on the startup marker, a fatal log line or an exit
+        until = time.time() + min(delay, timeout - elapsed)
+        while time.time() < until and not (watcher is not None and watcher.event.is_set() and not marker_handled) \
+                and not (process is not None and process.poll() is not None):
+            time.sleep(min(0.05, max(until - time.time(), 0)))
+        if watcher is not None and watcher.event.is_set() and not marker_handled:
+            # probe right away, then back off again from the shortest delay
+            marker_handled = True
+            delay = 0.25
+        else:
+            delay = min(delay * 2, max_delay)
     
-    print(f"\n{Colors.BRIGHT_RED}✗ Server failed to start after {max_retries * retry_delay} seconds{Colors.RESET}")
+    print(f"\n{Colors.BRIGHT_RED}✗ Server failed to start after {timeout:.0f} seconds{Colors.RESET}")
     print(f"{Colors.YELLOW}Tip: Try running with --attention_backend XFORMERS or check server logs{Colors.RESET}")
     return False
 
-def start_model_server(model_path, port=8123, rope_scaling=None, max_model_len=None, 
-                      tensor_parallel_size=1, gpu_devices="0", chat_template=None,
-                      attention_backend=None, disable_flashinfer_sampling=False):
-    """Start the model server in a subprocess with colored output streaming."""
+def server_command(model_path, port=8123, rope_scaling=None, max_model_len=None, 
+                   tensor_parallel_size=1, gpu_devices="0", chat_template=None,
+                   attention_backend=None, disable_flashinfer_sampling=False, profile='latency',
+                   enable_prefix_caching=False, log_file=None, log_sample=1):
+    """Build the local_model_serve.py command line for the model server."""
     
     cmd = [
         sys.executable, 'local_model_serve.py',
@@ -106,6 +146,23 @@ def start_model_server(model_path, port=8123, rope_scaling=None, max_model_len=N
     if disable_flashinfer_sampling:
         cmd.extend(['--disable_flashinfer_sampling'])
     
+    cmd.extend(['--profile', profile])
+    
+    if enable_prefix_caching:
+        cmd.append('--enable_prefix_caching')
+    
+    if log_file:
+        cmd.extend(['--log_file', log_file])
+    
+    if log_sample > 1:
+        cmd.extend(['--log_sample', str(log_sample)])
+    
+    return cmd
+
+def start_model_server(on_line=None, **server_kwargs):
+    """Start the model server in a subprocess with colored output streaming."""
+    
+    cmd = server_command(**server_kwargs)
     print(f"{Colors.BRIGHT_BLUE}Starting model server with command:{Colors.RESET}")
     print(f"{Colors.WHITE}{' '.join(cmd)}{Colors.RESET}\n")
     
@@ -119,12 +176,13 @@ def start_model_server(model_path, port=8123, rope_scaling=None, max_model_len=N
     
     # Start streaming output in background threads
     if stream_process_output != None:  # Check if function is available
-        stream_process_output(process, prefix="[Server]")
+        stream_process_output(process, prefix="[Server]", on_line=on_line)
     
     return process
 
 def run_inference(model_name, chain_type='forward', question_type='single', 
-                 k=5, val=1600, results_dir='./results', output_name=None):
+                 k=5, val=1600, results_dir='./results', output_name=None, max_model_len=None,
+                 stream=False, early_stop=False, n_samples=1):
     """Run the inference using the running model server."""
     
     if not output_name:
@@ -140,6 +198,15 @@ def run_inference(model_name, chain_type='forward', question_type='single',
         '--val', str(val),
         '--results_dir', results_dir
     ]
+    if max_model_len:
+        # prompts that do not fit are skipped when the dataset has a token index
+        cmd.extend(['--max_model_len', str(max_model_len)])
+    if stream:
+        cmd.append('--stream')
+    if early_stop:
+        cmd.append('--early_stop')
+    if n_samples > 1:
+        cmd.extend(['--n_samples', str(n_samples)])
     
     print(f"{Colors.BRIGHT_BLUE}Running inference:{Colors.RESET}")
     print(f"{Colors.WHITE}{' '.join(cmd)}{Colors.RESET}\n")
@@ -258,6 +325,11 @@ def main():
     parser.add_argument('--val', type=int, default=1600, choices=[160, 1600, 16000])
     parser.add_argument('--results_dir', default='./results', help='Results directory')
     parser.add_argument('--output_name', help='Output filename (auto-generated if not provided)')
+    parser.add_argument('--stream', action='store_true', help='Stream completions and record time to first token')
+    parser.add_argument('--early_stop', action='store_true',
+                       help='Stop each generation once a complete "## Answer: <number>" line was streamed')
+    parser.add_argument('--n_samples', type=int, default=1,
+                       help='Completions sampled per prompt in one request (majority vote / pass@k)')
     
     # Control options
     parser.add_argument('--serve_only', action='store_true', 
@@ -268,6 +340,17 @@ def main():
                        help='vLLM attention backend (helps with FlashInfer issues)')
     parser.add_argument('--disable_flashinfer_sampling', action='store_true',
                        help='Disable FlashInfer sampling (use for CUDA compatibility issues)')
+    parser.add_argument('--profile', default='latency', choices=['latency', 'throughput'],
+                       help='Server batching profile (throughput = continuous batching + prefix caching)')
+    parser.add_argument('--enable_prefix_caching', action='store_true',
+                       help='Enable vLLM prefix caching (always on with --profile throughput)')
+    parser.add_argument('--server_log', help='Tee the raw server output to this (rotating) log file')
+    parser.add_argument('--log_sample', type=int, default=1,
+                       help='Show every N-th routine server log line (errors, warnings and milestones always)')
+    parser.add_argument('--startup_timeout', type=float, default=600,
+                       help='Seconds to wait for the server to become ready')
+    parser.add_argument('--idle_timeout', type=float, default=0,
+                       help='Keep the server warm for reuse by later runs until idle this many seconds (0 = stop after this run)')
     parser.add_argument('--dry_run', action='store_true',
                        help='Print commands without executing (for testing)')
     
@@ -300,27 +383,28 @@ def main():
             print(f"Error: Invalid JSON in rope_scaling: {args.rope_scaling}")
             return
     
+    server_kwargs = dict(
+        model_path=args.model_path,
+        port=args.port,
+        rope_scaling=rope_scaling,
+        max_model_len=args.max_model_len,
+        tensor_parallel_size=args.tensor_parallel_size,
+        gpu_devices=args.gpu_devices,
+        chat_template=args.chat_template,
+        attention_backend=args.attention_backend,
+        disable_flashinfer_sampling=args.disable_flashinfer_sampling,
+        profile=args.profile,
+        enable_prefix_caching=args.enable_prefix_caching,
+        log_file=args.server_log,
+        log_sample=args.log_sample
+    )
+    
     # Handle dry run mode
     if args.dry_run:
         print(f"\n{Colors.BRIGHT_BLUE}Dry run mode - showing commands that would be executed:{Colors.RESET}")
         
         # Show server command
-        cmd = [
-            sys.executable, 'local_model_serve.py',
-            '--model_path', args.model_path,
-            '--port', str(args.port),
-            '--tensor_parallel_size', str(args.tensor_parallel_size),
-        ]
-        if rope_scaling:
-            cmd.extend(['--rope_scaling', json.dumps(rope_scaling)])
-        if args.max_model_len:
-            cmd.extend(['--max_model_len', str(args.max_model_len)])
-        if args.chat_template:
-            cmd.extend(['--chat_template', args.chat_template])
-        if args.attention_backend:
-            cmd.extend(['--attention_backend', args.attention_backend])
-        if args.disable_flashinfer_sampling:
-            cmd.append('--disable_flashinfer_sampling')
+        cmd = server_command(**server_kwargs)
         
         print(f"\n1. Server command:\n   {' '.join(cmd)}")
         
@@ -340,28 +424,51 @@ def main():
     add_local_model_to_utils(args.model_name, args.model_path, args.chat_template)
     
     server_process = None
+    health_process = None  # what check_server_health watches for an exit during startup
+    watcher = None
+    stop_following = None
+    pooled = False
     try:
-        # Start model server
-        print(f"\n{Colors.BG_BLUE}{Colors.WHITE} STARTING MODEL SERVER {Colors.RESET}")
-        print(f"{Colors.BRIGHT_BLUE}{'='*60}{Colors.RESET}")
-        
-        server_process = start_model_server(
-            model_path=args.model_path,
-            port=args.port,
-            rope_scaling=rope_scaling,
-            max_model_len=args.max_model_len,
-            tensor_parallel_size=args.tensor_parallel_size,
-            gpu_devices=args.gpu_devices,
-            chat_template=args.chat_template,
-            attention_backend=args.attention_backend,
-            disable_flashinfer_sampling=args.disable_flashinfer_sampling
-        )
+        if args.idle_timeout > 0:
+            # attach to (or start) a pooled server that outlives this run, see server_pool.py
+            try:
+                entry, started = server_pool.acquire(args.port, server_command(**server_kwargs), args.idle_timeout)
+            except RuntimeError as e:
+                print(f"{Colors.BRIGHT_RED}✗ {e}{Colors.RESET}")
+                return
+            pooled = True
+            if started:
+                print(f"\n{Colors.BG_BLUE}{Colors.WHITE} STARTING POOLED MODEL SERVER {Colors.RESET}")
+            else:
+                print(f"\n{Colors.BG_GREEN}{Colors.WHITE} REUSING WARM MODEL SERVER {Colors.RESET}")
+            print(f"{Colors.BRIGHT_BLUE}Server log: {entry['log']} "
+                  f"(stopped after {args.idle_timeout:.0f}s without clients){Colors.RESET}")
+            # fail fast like an owned server: on the daemon exiting or a fatal line in its log
+            watcher = ReadinessWatcher()
+            health_process = server_pool.DaemonHandle(entry['daemon_pid'])
+            stop_following = server_pool.follow_log(entry['log'], watcher.on_line,
+                                                    offset=entry.get('log_offset', 0) if started else None)
+        else:
+            # Start model server
+            print(f"\n{Colors.BG_BLUE}{Colors.WHITE} STARTING MODEL SERVER {Colors.RESET}")
+            print(f"{Colors.BRIGHT_BLUE}{'='*60}{Colors.RESET}")
+            
+            watcher = ReadinessWatcher()
+            server_process = start_model_server(on_line=watcher.on_line, **server_kwargs)
+            health_process = server_process
         
         # Wait for server to be ready
-        if not check_server_health(args.port):
+        ready = check_server_health(args.port, timeout=args.startup_timeout, process=health_process, watcher=watcher)
+        if stop_following is not None:
+            stop_following.set()
+        if not ready:
             print("Failed to start model server")
             return
         
+        if args.serve_only and pooled:
+            print(f"{Colors.BRIGHT_GREEN}Server is up; stop it with: python server_pool.py stop --port {args.port}{Colors.RESET}")
+            return
+        
         if args.serve_only:
             print(f"{Colors.BRIGHT_GREEN}Server started. Use Ctrl+C to stop.{Colors.RESET}")
             try:
@@ -381,7 +488,11 @@ def main():
             k=args.k,
             val=args.val,
             results_dir=args.results_dir,
-            output_name=args.output_name
+            output_name=args.output_name,
+            max_model_len=args.max_model_len,
+            stream=args.stream,
+            early_stop=args.early_stop,
+            n_samples=args.n_samples
         )
         
         if success:
@@ -393,6 +504,8 @@ def main():
         print(f"\n{Colors.BRIGHT_YELLOW}Interrupted by user{Colors.RESET}")
     
     finally:
+        if pooled:
+            server_pool.release(args.port)
         if server_process:
             print(f"{Colors.BRIGHT_YELLOW}Stopping model server...{Colors.RESET}")
             server_process.terminate()
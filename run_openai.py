@@ -1,136 +1,344 @@
+import time
+import asyncio
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import join
-from tqdm import tqdm
 from setproctitle import setproctitle
 
 from openai import OpenAI
 
 from utils import *
+from request_engine import OrderedWriter, RateLimitedClient, responses_request, run_jobs
+from telemetry import open_telemetry
+from response_cache import request_key
 
 
-def process_messages(custom_id, message, model_name):
+def process_messages(custom_id, message, model_name, n=1):
+    body = {"model": model_name,
+            "messages": message,
+            "max_tokens": 16384}
+    if n > 1:
+        body["n"] = n
     return {
         "custom_id": custom_id,
         "method": "POST",
         "url": "/v1/chat/completions",
-        "body": {"model": model_name,
-                 "messages": message,
-                 "max_tokens": 16384}
+        "body": body
     }
 
 
-def process_data(model_name, data_list):
+def process_data(model_name, data_list, n=1):
     data = []
     messages = []
     for idx, item in enumerate(data_list):
         message = process_messages(
             custom_id=f"request-{idx}",
             message=item,
-            model_name=model_name
+            model_name=model_name,
+            n=n
         )
         messages.append(message)
     return messages
 
 
-def run_batch(client, data, messages, output_name, **kwargs):
-    name_msg = output_name + '---msg'
-    name_batch = output_name + '---batch'
-    name_original = output_name + '---original'
-    name_output = output_name
+BATCH_MAX_REQUESTS = 50000            # API limit per batch
+BATCH_MAX_BYTES = 190 * 1024 * 1024   # API limit is 200 MB per input file
+BATCH_TERMINAL = {'completed', 'expired', 'cancelled', 'failed'}
 
-    if not os.path.exists(name_batch):
-        write_jsonl(data,     name_original)
-        write_jsonl(messages, name_msg)
 
-        batch_input_file = client.files.create(
-            file=open(name_msg, "rb"),
-            purpose="batch"
-        )
-        batch_input_file_id = batch_input_file.id
-        batch_created = client.batches.create(
-            input_file_id=batch_input_file_id,
-            endpoint="/v1/chat/completions",
-            completion_window="24h",
-            metadata={
-                "description": "nightly eval job"
-            }
-        )
-        write_json(batch_created.model_dump(), name_batch)
-        print(f'batch created: {name_batch}')
+def shard_requests(messages, max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES):
+    """Encode batch requests as JSONL shards that each fit the batch API limits.
+
+    Returns (custom_ids, payload) per shard.
+    """
+    shards, ids, lines, size = [], [], [], 0
+    for message in messages:
+        line = json_dumps(message).encode('utf-8') + b'\n'
+        if lines and (len(lines) >= max_requests or size + len(line) > max_bytes):
+            shards.append((ids, b''.join(lines)))
+            ids, lines, size = [], [], 0
+        ids.append(message['custom_id'])
+        lines.append(line)
+        size += len(line)
+    if lines:
+        shards.append((ids, b''.join(lines)))
+    return shards
+
+
+def submit_shard(client, shard, filename):
+    """Upload one (custom_ids, payload) shard and create its batch; the ids are kept in the batch
+    state so requests the batch loses can be resubmitted."""
+    custom_ids, payload = shard
+    # uploaded straight from memory, nothing is written next to the results
+    batch_input_file = client.files.create(
+        file=(filename, payload),
+        purpose="batch"
+    )
+    batch_created = client.batches.create(
+        input_file_id=batch_input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={
+            "description": "nightly eval job"
+        }
+    )
+    return {**batch_created.model_dump(), 'custom_ids': custom_ids}
+
+
+def response_content(item):
+    response = item.get('response') or {}
+    if item.get('error') or response.get('status_code', 200) != 200:
+        return None
+    choices = sorted(response['body']['choices'], key=lambda choice: choice.get('index', 0))
+    if len(choices) > 1:  # requests with n > 1
+        return [choice['message']['content'] for choice in choices]
+    return choices[0]['message']['content']
+
+
+def batch_request_key(message):
+    """Response-cache key of a batch request line (see ``process_messages``)."""
+    body = message['body']
+    return request_key(body['messages'], {key: value for key, value in body.items() if key != 'messages'})
+
+
+def ingest_output(client, file_id, entries, store, cache=None, keys=None):
+    """Stream a batch output file into ``store``, matching rows by ``custom_id``.
+
+    With a ``cache``, each answer is also stored under its request key from ``keys``.
+    """
+    written = failed = 0
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if not line.strip():
+                continue
+            item = json_loads(line)
+            entry = entries.get(item['custom_id'])
+            if entry is None or entry['idx'] in store:
+                continue
+            content = response_content(item)
+            if content is None:
+                failed += 1
+                continue
+            store.write({'generated': content, **entry})
+            if cache is not None and item['custom_id'] in keys:
+                body = item['response']['body']
+                usage = body.get('usage') or {}
+                cache.put(keys[item['custom_id']], body.get('model'), content, usage.get('prompt_tokens'),
+                          usage.get('completion_tokens'), body['choices'][0].get('finish_reason'))
+            written += 1
+    return written, failed
+
+
+class BatchWatcher(threading.Thread):
+    """Poll every shard of a batch run in the background and ingest outputs as shards finish.
+
+    With ``wait`` the watcher keeps polling every ``poll_interval`` seconds until every shard
+    is done; otherwise it makes a single pass. Shard state is saved to ``name_batch``. The
+    custom_ids of a finished shard that have no row in the output (failed requests, or an
+    expired or failed batch without output) are kept as its ``retry`` list for ``resubmit_lost``.
+    """
+
+    def __init__(self, client, batches, entries, output_name, name_batch, poll_interval=60, wait=False,
+                 cache=None, keys=None):
+        super().__init__(daemon=True)
+        self.client = client
+        self.batches = batches
+        self.entries = entries
+        self.output_name = output_name
+        self.name_batch = name_batch
+        self.poll_interval = poll_interval
+        self.wait = wait
+        self.cache = cache
+        self.keys = keys
+        self.store = None
+        self.error = None
+
+    def poll(self):
+        for shard, batch in enumerate(self.batches):
+            if batch.get('ingested'):
+                continue
+            status = self.client.batches.retrieve(batch['id'])
+            batch['status'] = status.status
+            if status.status not in BATCH_TERMINAL:
+                print(f'{status.status}: {self.name_batch} [{shard}] - {status.request_counts}')
+                continue
+            print(f'{status.status}: {self.name_batch} [{shard}]')
+            if self.store is None:
+                self.store = ResultStore(self.output_name)
+            if status.output_file_id:
+                written, failed = ingest_output(self.client, status.output_file_id, self.entries, self.store,
+                                                self.cache, self.keys)
+                print(f'  {written} rows written to {self.output_name}, {failed} failed requests')
+            # shards submitted by older versions have no custom_ids and cannot be retried
+            lost = [custom_id for custom_id in batch.get('custom_ids', [])
+                    if custom_id in self.entries and self.entries[custom_id]['idx'] not in self.store]
+            if lost:
+                batch['retry'] = lost
+                print(f'  {len(lost)} requests without a response, resubmitted by the next run')
+            batch['ingested'] = True
+        write_json(self.batches, self.name_batch)
+        return all(batch.get('ingested') for batch in self.batches)
+
+    def run(self):
+        try:
+            while not self.poll() and self.wait:
+                time.sleep(self.poll_interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            if self.store is not None:
+                self.store.close()
+
+
+def serve_batch_from_cache(messages, data, output_name, cache, keys, first):
+    """Write the rows whose request is in ``cache`` to ``output_name``; return the requests left.
+
+    Cache hits are only looked up on the ``first`` submission. The served custom_ids are saved
+    to ``output_name---cached``, so a retry of failed shard submissions splits the remaining
+    requests into the same shards as before.
+    """
+    name_cached = output_name + '---cached'
+    if os.path.exists(name_cached):
+        served = set(read_json(name_cached))
+    elif first and cache is not None:
+        served = set()
+        store = ResultStore(output_name)
+        for message, entry in zip(messages, data):
+            hit = cache.get(keys[message['custom_id']], samples=message['body'].get('n', 1) > 1)
+            if hit is None:
+                continue
+            served.add(message['custom_id'])
+            if entry['idx'] not in store:
+                store.write({'generated': hit[0], **entry})
+        store.close()
+        write_json(sorted(served), name_cached)
+        print(f'{len(served)} of {len(messages)} requests answered from the response cache')
     else:
-        batch = read_json(name_batch)
+        served = set()
+    return [message for message in messages if message['custom_id'] not in served]
+
+
+def resubmit_lost(client, batches, messages, output_name):
+    """Submit the ``retry`` requests of finished shards as new shards appended to ``batches``.
+
+    Ids are removed from ``retry`` as their new shard is submitted, so a failed submission is
+    retried by the next call without sending any request twice.
+    """
+    by_id = {message['custom_id']: message for message in messages}
+    lost = [batch for batch in batches if batch.get('retry')]
+    pending = [by_id[custom_id] for batch in lost for custom_id in batch['retry'] if custom_id in by_id]
+    basename = os.path.basename(output_name)
+    resubmitted = 0
+    for shard in shard_requests(pending):
         try:
-            batch_id = client.batches.retrieve(batch['id'])
-        except:
-            print('batch exist.. but different API key')
-            return
+            batch = submit_shard(client, shard, f'{basename}-{len(batches)}.jsonl')
+        except Exception as e:
+            print(f'lost requests not resubmitted: {e}')
+            break
+        batches.append(batch)
+        submitted = set(shard[0])
+        for item in lost:
+            item['retry'] = [custom_id for custom_id in item['retry'] if custom_id not in submitted]
+        resubmitted += len(submitted)
+    print(f'{resubmitted} of {len(pending)} lost requests resubmitted')
 
-        if batch_id.status == 'completed':
-            print(f'completed: {name_batch}')
-            if not os.path.exists(name_output):
-                responses = client.files.content(batch_id.output_file_id).text
-                input_file = read_jsonl(name_original)
 
-                temporal_filename = 'temporal_fileeeeeee.jsonl'
-                write_file(responses, temporal_filename)
-                responses = read_jsonl(temporal_filename)
-                responses = [item['response']['body']['choices'][0]['message']['content'] for item in responses]
+def run_batch(client, data, messages, output_name, **kwargs):
+    """Submit ``messages`` as one or more batch shards, then poll them and ingest finished outputs.
 
-                input_file = [{'generated': response, **others} for response, others in zip(responses, input_file)]
-                write_jsonl(input_file, name_output)
-                if os.path.exists(temporal_filename):
-                    os.remove(temporal_filename)
+    Re-invoking with the same ``output_name`` polls the existing shards and resubmits the
+    requests that finished shards lost; with ``wait=True`` the call blocks until every shard is
+    done. With a ``cache`` (``ResponseCache``) requests that
+    were answered before are not submitted, and ingested answers are added to the cache.
+    """
+    name_batch = output_name + '---batch'
+    name_original = output_name + '---original'
+    cache = kwargs.get('cache')
+    keys = {message['custom_id']: batch_request_key(message) for message in messages} if cache is not None else None
+
+    if os.path.exists(name_batch):
+        batches = read_json(name_batch)
+        if isinstance(batches, dict):  # single batch written by older versions
+            batches = [batches]
+    else:
+        write_jsonl(data, name_original)
+        batches = []
+    shards = None
+    if not batches or None in batches:
+        # first submission, or a retry of the shards whose submission failed
+        pending = serve_batch_from_cache(messages, data, output_name, cache, keys, first=not batches)
+        shards = shard_requests(pending)
+        batches = batches or [None] * len(shards)
+        missing = [shard for shard, batch in enumerate(batches) if batch is None]
+        basename = os.path.basename(output_name)
+        with ThreadPoolExecutor(max_workers=min(len(missing), 8) or 1) as pool:
+            futures = {
+                pool.submit(submit_shard, client, shards[shard], f'{basename}-{shard}.jsonl'): shard
+                for shard in missing
+            }
+            for future in as_completed(futures):
+                try:
+                    batches[futures[future]] = future.result()
+                except Exception as e:
+                    print(f'shard {futures[future]} not submitted: {e}')
+        write_json(batches, name_batch)
+        print(f'batch created: {name_batch} ({len(batches) - batches.count(None)}/{len(batches)} shards)')
+        if None in batches:
+            return
+    elif any(batch.get('retry') for batch in batches):
+        resubmit_lost(client, batches, messages, output_name)
+        write_json(batches, name_batch)
 
-        elif batch_id.status == 'expired':
-            print(f'expired: {name_batch}')
-        else:
-            print(f'{batch_id.status}: {name_batch} - {batch_id.request_counts}')
-            # client.batches.cancel(batch['id'])
+    # custom_id is "request-{position}" in the submitted data, see process_data
+    entries = {f"request-{pos}": entry for pos, entry in enumerate(iter_jsonl(name_original))}
+    watcher = BatchWatcher(client, batches, entries, output_name, name_batch,
+                           poll_interval=kwargs.get('poll_interval', 60), wait=kwargs.get('wait', False),
+                           cache=cache, keys=keys)
+    # polling runs in a daemon thread so Ctrl-C during a long wait returns at once;
+    # shard state is saved after every pass, so the next call picks up where this one stopped
+    watcher.start()
+    watcher.join()
+    if watcher.error is not None:
+        print(f'batch exist.. but polling failed (different API key?): {watcher.error}')
 
 
 def run_chat(client, data, messages, output_name, **kwargs):
-    if os.path.exists(output_name):
-        _exist = read_jsonl(output_name)
-        _exist_ids = [i['idx'] for i in _exist]  # CAUTION: "idx" key sould be included in data
-        for pos, instance in enumerate(data):
-            if instance['idx'] in _exist_ids:
-                data[pos] = _exist[_exist_ids.index(instance['idx'])]
-
-    result_writer = open(output_name, 'w')
-
-    for entry, message in tqdm(zip(data, messages)):
-        if entry.get('generated', None) is not None:
-            result_writer.write(json.dumps(entry) + '\n')
-            result_writer.flush()
+    """Send chat (or, with ``tool=True``, responses API) requests through the request engine.
+
+    ``client`` is a ``RateLimitedClient`` or a bare ``AsyncOpenAI`` client. Every request is
+    recorded in the model's telemetry file next to ``output_name``, labelled with ``tags``, and
+    with a ``cache`` (``ResponseCache``) requests answered before are not sent again.
+    """
+    store = ResultStore(output_name)  # CAUTION: "idx" key sould be included in data
+    sink = OrderedWriter(store)
+    tags = kwargs.get('tags') or {'model': kwargs['model_name']}
+    jobs = []
+    for entry, message in zip(data, messages):
+        if entry['idx'] in store:
             continue
-        success = False
-        while not success:
-            if kwargs.get("tool", False):
-                completion = client.responses.create(
-                    model=kwargs['model_name'],
-                    tools=[
-                        {
-                            "type": "code_interpreter",
-                            "container": {"type": "auto"}
-                        }
-                    ],
-                    instructions=message[0]['content'],
-                    input=message[1]['content'],
-                    temperature=1,
-                )
-                # generation = completion.output[0].content[0].text
-                generation = completion.output_text
-            else:
-                completion = client.chat.completions.create(
-                    model=kwargs['model_name'],
-                    messages=message,
-                    temperature=1,
-                )
-                generation = completion.choices[0].message.content
-            entry['generated'] = generation
-            success = True
-
-        result_writer.write(json.dumps(entry) + '\n')
-        result_writer.flush()
-
-    result_writer.close()
+        jobs.append({'pos': len(jobs), 'message': message, 'entry': entry, 'sink': sink, 'tags': tags})
+
+    params = {'model': kwargs['model_name'], 'temperature': 1}
+    if kwargs.get("tool", False):
+        if not isinstance(client, RateLimitedClient):
+            client = RateLimitedClient(client)
+        client.request_fn = responses_request
+        params['tools'] = [
+            {
+                "type": "code_interpreter",
+                "container": {"type": "auto"}
+            }
+        ]
+    elif kwargs.get('n', 1) > 1:
+        # the responses API used with tools has no n; chat completions sample n choices per request
+        params['n'] = kwargs['n']
+    telemetry = open_telemetry(os.path.dirname(output_name), kwargs['model_name'])
+    try:
+        meter = asyncio.run(run_jobs(client, jobs, concurrency=kwargs.get('concurrency', 16),
+                                     telemetry=telemetry, cache=kwargs.get('cache'), **params))
+        print(meter.summary())
+        print(meter.latency_report())
+    finally:
+        telemetry.close()
+        store.close()
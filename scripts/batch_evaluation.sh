@@ -7,6 +7,9 @@ set -e  # Exit on any error
 MODEL_PATH="${1:-/exp/model/Huggingface/meta-llama/Llama-3.2-1B}"
 ATTENTION_BACKEND="${2:-XFORMERS}"
 PORT="${3:-8123}"
+SERVER_LOG="logs/server_${PORT}.log"
+
+source scripts/wait_for_server.sh
 
 MODEL_NAME=$(basename "$MODEL_PATH")
 
@@ -64,6 +67,7 @@ trap cleanup EXIT INT TERM
 # Start model server once for all evaluations
 echo ""
 echo "🚀 Starting model server for batch evaluation..."
+mkdir -p logs
 python3 local_model_serve.py \
     --model_path "$MODEL_PATH" \
     --port "$PORT" \
@@ -71,25 +75,13 @@ python3 local_model_serve.py \
     --disable_flashinfer_sampling \
     --api_key needlechain \
     --tensor_parallel_size 1 \
-    --gpu_devices 0 &
+    --gpu_devices 0 > >(tee "$SERVER_LOG") 2>&1 &
 
 SERVER_PID=$!
 
 # Wait for server to be ready
 echo "⏳ Waiting for server to be ready..."
-max_wait=120
-wait_count=0
-while [ $wait_count -lt $max_wait ]; do
-    if curl -s "http://localhost:$PORT/health" > /dev/null 2>&1; then
-        echo "✅ Server is ready!"
-        break
-    fi
-    sleep 2
-    wait_count=$((wait_count + 2))
-done
-
-if [ $wait_count -ge $max_wait ]; then
-    echo "❌ Server failed to start"
+if ! wait_for_server "$SERVER_PID" "$SERVER_LOG" "$PORT"; then
     exit 1
 fi
 
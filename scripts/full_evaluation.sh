@@ -12,6 +12,9 @@ CHAIN_TYPE="${3:-forward}"
 QUESTION_TYPE="${4:-single}"
 ATTENTION_BACKEND="${5:-XFORMERS}"
 PORT="${6:-8123}"
+SERVER_LOG="logs/server_${PORT}.log"
+
+source scripts/wait_for_server.sh
 
 # Extract model name from path
 MODEL_NAME=$(basename "$MODEL_PATH")
@@ -75,6 +78,7 @@ trap cleanup EXIT INT TERM
 
 # Stage 1: Start model server in background
 echo "🔄 Stage 1: Starting model server..."
+mkdir -p logs
 python3 local_model_serve.py \
     --model_path "$MODEL_PATH" \
     --port "$PORT" \
@@ -82,27 +86,14 @@ python3 local_model_serve.py \
     --disable_flashinfer_sampling \
     --api_key needlechain \
     --tensor_parallel_size 1 \
-    --gpu_devices 0 &
+    --gpu_devices 0 > >(tee "$SERVER_LOG") 2>&1 &
 
 SERVER_PID=$!
 echo "Model server started with PID: $SERVER_PID"
 
 # Wait for server to be ready
 echo "⏳ Waiting for server to be ready..."
-max_wait=120  # 2 minutes
-wait_count=0
-while [ $wait_count -lt $max_wait ]; do
-    if curl -s "http://localhost:$PORT/health" > /dev/null 2>&1; then
-        echo "✅ Server is ready!"
-        break
-    fi
-    sleep 2
-    wait_count=$((wait_count + 2))
-    echo "Waiting... ($wait_count/${max_wait}s)"
-done
-
-if [ $wait_count -ge $max_wait ]; then
-    echo "❌ Server failed to start within $max_wait seconds"
+if ! wait_for_server "$SERVER_PID" "$SERVER_LOG" "$PORT"; then
     exit 1
 fi
 
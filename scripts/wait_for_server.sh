@@ -0,0 +1,32 @@
+#!/bin/bash
+# Readiness check for a vLLM server started in the background with its output in a log file.
+# Usage: source scripts/wait_for_server.sh
+#        wait_for_server "$SERVER_PID" "$SERVER_LOG" "$PORT" [max_wait_seconds]
+#
+# Returns once /health answers, polled with exponential backoff (0.25s doubling up to 2s), and
+# fails as soon as the server exits or logs a fatal error (patterns as in run_local.py).
+
+VLLM_FATAL_PATTERN='CUDA out of memory|OutOfMemoryError|Engine core initialization failed|EngineDeadError|Address already in use|No available memory for the cache blocks'
+
+wait_for_server() {
+    local pid="$1" log="$2" port="$3" max_wait="${4:-600}"
+    local delay=0.25 start=$SECONDS
+    while [ $((SECONDS - start)) -lt "$max_wait" ]; do
+        if grep -qE "$VLLM_FATAL_PATTERN" "$log" 2>/dev/null; then
+            echo "❌ Server failed to start: $(grep -m1 -E "$VLLM_FATAL_PATTERN" "$log")"
+            return 1
+        fi
+        if ! kill -0 "$pid" 2>/dev/null; then
+            echo "❌ Server exited during startup (see $log)"
+            return 1
+        fi
+        if curl -sf "http://localhost:$port/health" > /dev/null 2>&1; then
+            echo "✅ Server is ready! ($((SECONDS - start))s)"
+            return 0
+        fi
+        sleep "$delay"
+        delay=$(awk -v d="$delay" 'BEGIN { d *= 2; print (d > 2 ? 2 : d) }')
+    done
+    echo "❌ Server failed to start within $max_wait seconds"
+    return 1
+}
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Keeps local model servers warm across `run_local.py` invocations.
+
+Each server is owned by a small daemon that starts `local_model_serve.py`, and stops it once no
+client has used it for ``--idle_timeout`` seconds. The daemon is recorded in a registry file per
+port; a client holding a lease keeps the server alive:
+
+    ~/.cache/needlechain/servers/port-8123.json     daemon pid, server command, log file
+    ~/.cache/needlechain/servers/port-8123.lock     serializes attach / start / shutdown
+    ~/.cache/needlechain/servers/port-8123.leases/  one file per attached client pid
+
+`run_local.py --idle_timeout 1800` attaches to the server on its port when it was started with
+the same command, and starts a new daemon otherwise.
+
+Usage:
+    python server_pool.py list
+    python server_pool.py stop --port 8123
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import hashlib
+import argparse
+import threading
+import subprocess
+from contextlib import contextmanager
+
+POOL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'needlechain', 'servers')
+CHECK_INTERVAL = 5
+
+
+def registry_path(port, pool_dir=POOL_DIR):
+    return os.path.join(pool_dir, f'port-{port}.json')
+
+
+def lease_dir(port, pool_dir=POOL_DIR):
+    return os.path.join(pool_dir, f'port-{port}.leases')
+
+
+def command_signature(cmd):
+    """Hash of the server command; servers started with the same command are interchangeable."""
+    return hashlib.sha1(json.dumps(cmd).encode()).hexdigest()
+
+
+def command_model(cmd):
+    return cmd[cmd.index('--model_path') + 1] if '--model_path' in cmd else ' '.join(cmd)
+
+
+def pid_alive(pid):
+    try:
+        # reap it if it is our own child that already exited (e.g. a daemon this process started)
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@contextmanager
+def port_lock(port, pool_dir=POOL_DIR):
+    os.makedirs(pool_dir, exist_ok=True)
+    with open(os.path.join(pool_dir, f'port-{port}.lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_registry(port, pool_dir=POOL_DIR):
+    """The registry entry of the daemon on ``port``, or None (stale entries are removed)."""
+    filename = registry_path(port, pool_dir)
+    try:
+        with open(filename) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not pid_alive(entry['daemon_pid']):
+        os.remove(filename)
+        return None
+    return entry
+
+
+def live_leases(port, pool_dir=POOL_DIR):
+    """Pids of the attached clients, dropping the leases of clients that died."""
+    directory = lease_dir(port, pool_dir)
+    pids = []
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if pid_alive(int(name)):
+            pids.append(int(name))
+        else:
+            os.remove(os.path.join(directory, name))
+    return pids
+
+
+def acquire(port, cmd, idle_timeout, pool_dir=POOL_DIR):
+    """Lease the server on ``port`` started with ``cmd``, starting a daemon for it if needed.
+
+    Returns ``(entry, started)``; ``started`` is False when an already running server was reused.
+    The registry ``entry`` carries the ``daemon_pid`` and the server ``log`` (written from byte
+    ``log_offset`` on by this daemon), for watching the startup with ``DaemonHandle`` and ``follow_log``.
+    Raises RuntimeError if the port is held by a server with a different command that is in use.
+    """
+    signature = command_signature(cmd)
+    while True:
+        with port_lock(port, pool_dir):
+            entry = read_registry(port, pool_dir)
+            if entry is None or entry['signature'] == signature:
+                started = entry is None
+                if started:
+                    entry = start_daemon(port, cmd, idle_timeout, pool_dir)
+                os.makedirs(lease_dir(port, pool_dir), exist_ok=True)
+                open(os.path.join(lease_dir(port, pool_dir), str(os.getpid())), 'w').close()
+                return entry, started
+            if live_leases(port, pool_dir):
+                raise RuntimeError(f"port {port} is in use by another server ({command_model(entry['command'])}); "
+                                   f"pick another --port or stop it with: python server_pool.py stop --port {port}")
+        # the daemon takes the lock on its way out, so it is stopped outside of it
+        print(f"stopping idle server on port {port} started with a different configuration")
+        stop_daemon(entry)
+
+
+def start_daemon(port, cmd, idle_timeout, pool_dir=POOL_DIR):
+    """Spawn a detached daemon serving ``cmd`` and register it; the caller holds the port lock."""
+    log = os.path.join(pool_dir, f'port-{port}.log')
+    # the log is appended to by every daemon on this port; this one's output starts here
+    log_offset = os.path.getsize(log) if os.path.exists(log) else 0
+    daemon = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'daemon', '--port', str(port),
+         '--idle_timeout', str(idle_timeout), '--pool_dir', pool_dir, '--log', log, '--', *cmd],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    entry = {'daemon_pid': daemon.pid, 'port': port, 'signature': command_signature(cmd), 'command': cmd,
+             'idle_timeout': idle_timeout, 'log': log, 'log_offset': log_offset, 'started': time.time()}
+    with open(registry_path(port, pool_dir), 'w') as f:
+        json.dump(entry, f)
+    return entry
+
+
+class DaemonHandle:
+    """``Popen``-like view of a daemon by pid: ``poll()`` is None while it runs."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        except ChildProcessError:
+            # started by another client, so its exit status is not ours to collect
+            if not pid_alive(self.pid):
+                self.returncode = 'unknown'
+        return self.returncode
+
+
+def follow_log(filename, on_line, offset=None, interval=0.2):
+    """Call ``on_line`` with every line appended to ``filename`` from byte ``offset`` on (the
+    current end if None) in a daemon thread; set the returned event to stop following."""
+    stop = threading.Event()
+
+    def follow():
+        while not os.path.exists(filename):
+            if stop.wait(interval):
+                return
+        with open(filename, 'rb') as f:
+            f.seek(0, os.SEEK_END) if offset is None else f.seek(offset)
+            partial = b''
+            while not stop.is_set():
+                chunk = f.readline()
+                if not chunk:
+                    stop.wait(interval)
+                    continue
+                partial += chunk
+                if partial.endswith(b'\n'):
+                    line = partial.decode('utf-8', errors='ignore').rstrip()
+                    partial = b''
+                    if line:
+                        on_line(line)
+
+    threading.Thread(target=follow, daemon=True).start()
+    return stop
+
+
+def release(port, pool_dir=POOL_DIR):
+    """Drop this process's lease; the daemon's idle timer starts once no lease is left."""
+    try:
+        os.remove(os.path.join(lease_dir(port, pool_dir), str(os.getpid())))
+    except FileNotFoundError:
+        pass
+
+
+def stop_daemon(entry, timeout=60):
+    try:
+        os.kill(entry['daemon_pid'], signal.SIGTERM)
+    except ProcessLookupError:
+        return  # exited on its idle timeout since the registry was read
+    deadline = time.time() + timeout
+    while pid_alive(entry['daemon_pid']) and time.time() < deadline:
+        time.sleep(0.2)
+
+
+def stop_server(process, timeout=30):
+    """Terminate the server's whole process group (local_model_serve.py, its shell and vLLM)."""
+    if process.poll() is not None:
+        return
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def run_daemon(port, cmd, idle_timeout, pool_dir=POOL_DIR, log=None):
+    """Run the server until it has been idle for ``idle_timeout`` seconds, it exits, or SIGTERM.
+
+    Returns the server's exit code if it exited on its own, else 0.
+    """
+    with open(log or os.devnull, 'ab') as log_file:
+        process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    last_used = time.time()
+    try:
+        while True:
+            try:
+                # returns at once when the server exits, so waiting clients see the daemon go
+                return process.wait(timeout=CHECK_INTERVAL)
+            except subprocess.TimeoutExpired:
+                pass
+            with port_lock(port, pool_dir):
+                if live_leases(port, pool_dir):
+                    last_used = time.time()
+                elif time.time() - last_used > idle_timeout:
+                    # unregister under the lock so that no client attaches to a server being stopped
+                    unregister(port, pool_dir)
+                    return 0
+    finally:
+        stop_server(process)
+        with port_lock(port, pool_dir):
+            unregister(port, pool_dir)
+
+
+def unregister(port, pool_dir=POOL_DIR):
+    """Remove the registry entry on ``port`` if it belongs to this daemon."""
+    entry = read_registry(port, pool_dir)
+    if entry is not None and entry['daemon_pid'] == os.getpid():
+        os.remove(registry_path(port, pool_dir))
+
+
+def list_servers(pool_dir=POOL_DIR):
+    names = sorted(os.listdir(pool_dir)) if os.path.isdir(pool_dir) else []
+    ports = [int(name[len('port-'):-len('.json')]) for name in names if name.endswith('.json')]
+    for port in ports:
+        entry = read_registry(port, pool_dir)
+        if entry is None:
+            continue
+        uptime = (time.time() - entry['started']) / 60
+        print(f"port {port}: {command_model(entry['command'])} (daemon pid {entry['daemon_pid']}, up {uptime:.0f} min, "
+              f"{len(live_leases(port, pool_dir))} clients, idle timeout {entry['idle_timeout']}s, log {entry['log']})")
+    if not ports:
+        print(f"no servers in {pool_dir}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['list', 'stop', 'daemon'])
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--pool_dir', default=POOL_DIR, help='directory of the registry, lock and lease files')
+    parser.add_argument('--idle_timeout', type=float, default=1800, help='daemon: seconds without clients before stopping')
+    parser.add_argument('--log', default=None, help='daemon: file the server output is written to')
+    # daemon: the server command follows "--"
+    argv, server_command = sys.argv[1:], []
+    if '--' in argv:
+        argv, server_command = argv[:argv.index('--')], argv[argv.index('--') + 1:]
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        list_servers(args.pool_dir)
+    elif args.command == 'stop':
+        with port_lock(args.port, args.pool_dir):
+            entry = read_registry(args.port, args.pool_dir)
+        if entry is None:
+            print(f"no server on port {args.port}")
+        else:
+            stop_daemon(entry)
+            print(f"stopped server on port {args.port}")
+    else:
+        sys.exit(run_daemon(args.port, server_command, args.idle_timeout, args.pool_dir, args.log))
@@ -0,0 +1,137 @@
+"""
+Per-request telemetry of inference runs.
+
+The request engine appends one row per request to ``<results_dir>/telemetry/<model>.jsonl``:
+the cell tags (model, chain_type, k, question_type), idx, start time, latency, time spent
+waiting for the rate limiter and retry backoff, time to first token (streaming only),
+attempts, prompt/completion tokens, finish_reason and the error of failed requests.
+The subdirectory keeps these rows out of the result files that evaluate.py scores.
+
+Usage:
+    python telemetry.py --results_dir ./results                # per model / chain_type / k
+    python telemetry.py --by model,question_type --output telemetry.tsv
+"""
+
+import os
+import csv
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from utils import JsonlWriter, iter_jsonl
+
+GROUP_KEYS = ['model', 'chain_type', 'k', 'question_type']
+SUMMARY_COLUMNS = ['n', 'failed', 'length_stops', 'req_per_s', 'prompt_tok_per_s', 'completion_tok_per_s',
+                   'latency_p50', 'latency_p95', 'latency_p99', 'ttft_p50', 'ttft_p95', 'wait_p50', 'wait_p95',
+                   'mean_prompt_tokens', 'mean_completion_tokens']
+
+
+def telemetry_path(results_dir, model):
+    return os.path.join(results_dir, 'telemetry', f'{model}.jsonl')
+
+
+def open_telemetry(results_dir, model):
+    """Append-mode ``JsonlWriter`` for the model's telemetry rows (pass it to ``run_jobs``)."""
+    filename = telemetry_path(results_dir, model)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return JsonlWriter(filename, mode='a')
+
+
+def percentiles(values, qs):
+    values = [value for value in values if value is not None]
+    if not values:
+        return [float('nan')] * len(qs)
+    return np.percentile(values, qs).tolist()
+
+
+def summarize_rows(rows):
+    """Throughput and latency percentiles of one group of telemetry rows.
+
+    Throughput is taken over the group's wall-clock span, from its first request start to its
+    last request end, so concurrent requests are not double counted.
+    """
+    ok = [row for row in rows if not row.get('error')]
+    span = max(row['start'] + row['latency'] for row in rows) - min(row['start'] for row in rows)
+    span = max(span, 1e-9)
+    prompt_tokens = [row['prompt_tokens'] for row in ok if row.get('prompt_tokens') is not None]
+    completion_tokens = [row['completion_tokens'] for row in ok if row.get('completion_tokens') is not None]
+    latency = percentiles([row['latency'] for row in ok], [50, 95, 99])
+    ttft = percentiles([row.get('ttft') for row in ok], [50, 95])
+    wait = percentiles([row.get('wait') for row in rows], [50, 95])
+    return dict(zip(SUMMARY_COLUMNS, [
+        len(rows),
+        len(rows) - len(ok),
+        sum(row.get('finish_reason') == 'length' for row in ok),
+        len(ok) / span,
+        sum(prompt_tokens) / span,
+        sum(completion_tokens) / span,
+        *latency, *ttft, *wait,
+        float(np.mean(prompt_tokens)) if prompt_tokens else float('nan'),
+        float(np.mean(completion_tokens)) if completion_tokens else float('nan'),
+    ]))
+
+
+def sort_key(value):
+    # numbers (k) in numeric order, before strings and missing tags
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, str(value))
+
+
+def format_seconds(value):
+    return '-' if np.isnan(value) else f'{value:.2f}s'
+
+
+def summarize(filenames, by=('model', 'chain_type', 'k')):
+    groups = defaultdict(list)
+    for filename in filenames:
+        for row in iter_jsonl(filename):
+            groups[tuple(row.get(key) for key in by)].append(row)
+    return [
+        {**dict(zip(by, key)), **summarize_rows(rows)}
+        for key, rows in sorted(groups.items(), key=lambda item: [sort_key(value) for value in item[0]])
+    ]
+
+
+def print_summary(summary, by):
+    header = list(by) + ['n', 'failed', 'req/s', 'out tok/s', 'p50', 'p95', 'p99', 'ttft p50', 'wait p50']
+    print('\t'.join(header))
+    for row in summary:
+        print('\t'.join([str(row[key]) for key in by] + [
+            str(row['n']), str(row['failed']), f"{row['req_per_s']:.2f}", f"{row['completion_tok_per_s']:.1f}",
+            *[format_seconds(row[key]) for key in ['latency_p50', 'latency_p95', 'latency_p99',
+                                                   'ttft_p50', 'wait_p50']],
+        ]))
+
+
+def write_summary(summary, by, filename):
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(by) + SUMMARY_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(summary)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--results_dir', default='./results')
+    parser.add_argument('--model', default=None, help='only this model (default: every telemetry file)')
+    parser.add_argument('--by', default='model,chain_type,k', help=f'comma-separated grouping keys of {GROUP_KEYS}')
+    parser.add_argument('--output', default=None, help='also write the summary as a TSV table')
+    args = parser.parse_args()
+
+    telemetry_dir = os.path.join(args.results_dir, 'telemetry')
+    if args.model:
+        files = [filename for filename in [telemetry_path(args.results_dir, args.model)] if os.path.exists(filename)]
+    else:
+        names = sorted(os.listdir(telemetry_dir)) if os.path.isdir(telemetry_dir) else []
+        files = [os.path.join(telemetry_dir, name) for name in names if name.endswith('.jsonl')]
+    if not files:
+        print(f"no telemetry in {telemetry_dir}")
+    else:
+        by = args.by.split(',')
+        summary = summarize(files, by)
+        print_summary(summary, by)
+        if args.output:
+            write_summary(summary, by, args.output)
+            print(f"\nsummary saved: {args.output}")
@@ -162,6 +162,10 @@ def test_dry_run_commands():
              '--model_path', str(mock_model_dir),
              '--attention_backend', 'XFORMERS', 
              '--disable_flashinfer_sampling',
+             '--dry_run'],
+            [sys.executable, 'local_model_serve.py',
+             '--model_path', str(mock_model_dir),
+             '--profile', 'throughput',
              '--dry_run']
         ]
         
@@ -10,7 +10,9 @@ import os
 import tempfile
 import json
 import time
+import argparse
 from pathlib import Path
+from contextlib import contextmanager
 
 def create_mock_model(model_dir):
     """Create a minimal mock model structure."""
@@ -143,6 +145,157 @@ def test_fallback_script():
         print(f"❌ Error: {e}")
         return False
 
+@contextmanager
+def mock_server_run(rows=10, chain_type='forward', **server_kwargs):
+    """Generate a k=5 dataset, start the mock server and yield what a run against it needs.
+
+    Yields a namespace with ``server``, ``temp_dir``, ``client``, ``messages``, ``data`` and
+    ``output_name``; the server is shut down on exit.
+    """
+    from mock_server import serve
+    from inference_call import build_prompts, load_dataset, make_client
+
+    server = serve(**server_kwargs)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            data_dir = Path(temp_dir) / "data"
+            data_dir.mkdir()
+            cmd = [sys.executable, 'make_data.py', '--k', '5', '--n', str(rows), '--seed', '0',
+                   '--results_dir', str(data_dir)]
+            subprocess.run(cmd, capture_output=True, text=True, timeout=60, check=True)
+
+            messages, data = build_prompts(load_dataset(5, 1600, str(data_dir)), chain_type, 'single')
+            client = make_client(argparse.Namespace(max_retries=8, timeout=10),
+                                 base_url=f"http://127.0.0.1:{server.server_port}/v1", api_key="needlechain")
+            yield argparse.Namespace(server=server, temp_dir=Path(temp_dir), client=client, messages=messages,
+                                     data=data, output_name=str(Path(temp_dir) / "mock.jsonl"))
+    finally:
+        server.shutdown()
+
+def test_mock_server_pipeline():
+    """Run make_data -> request engine -> evaluate against the mock server, with injected errors."""
+    print("\n🧪 Testing request engine against the mock server...")
+
+    from inference_call import run_hf
+    from evaluate import score_file
+
+    with mock_server_run(rows=20, chain_type='chaotic', error_rate=0.3, latency='uniform:0,0.02') as run:
+        run_hf(run.client, run.data, run.messages, run.output_name, model_name='QwQ', concurrency=4)
+
+        score, _ = score_file(run.output_name, limit=0)
+        assert score['n'] == 20 and score['accuracy'] == 1.0, f"unexpected score: {score}"
+    print("✅ All rows answered and scored correctly despite injected errors")
+
+def test_mock_server_early_stop():
+    """Stream from the mock server and stop each generation at its answer line."""
+    print("\n🧪 Testing streamed early stop against the mock server...")
+
+    from inference_call import run_hf
+    from evaluate import score_file
+    from utils import read_jsonl
+
+    with mock_server_run(rows=10, tail_tokens=256) as run:
+        run_hf(run.client, run.data, run.messages, run.output_name, model_name='QwQ', concurrency=4,
+               early_stop=True)
+
+        score, _ = score_file(run.output_name, limit=0)
+        telemetry = read_jsonl(str(run.temp_dir / "telemetry" / "QwQ.jsonl"))
+        assert score['n'] == 10 and score['accuracy'] == 1.0, f"unexpected score: {score}"
+        assert len(telemetry) == 10, f"{len(telemetry)} telemetry rows"
+        assert all(row['finish_reason'] == 'answer' and row['ttft'] is not None for row in telemetry), \
+            f"generation not stopped at its answer: {telemetry[:1]}"
+        assert all(row['generated'].endswith('\n') for row in read_jsonl(run.output_name)), \
+            "text after the answer line was kept"
+    print("✅ Every generation stopped at its answer and scored correctly")
+
+def test_mock_server_samples():
+    """Sample several completions per prompt in one request and score majority vote and pass@k."""
+    print("\n🧪 Testing multi-sample requests against the mock server...")
+
+    from inference_call import run_hf
+    from evaluate import score_file
+    from utils import read_jsonl
+
+    with mock_server_run(rows=10) as run:
+        run_hf(run.client, run.data, run.messages, run.output_name, model_name='QwQ', concurrency=4, n=4)
+
+        score, _ = score_file(run.output_name, limit=0, pass_k=(1, 4))
+        assert run.server.state.requests == 10, f"{run.server.state.requests} requests for 10 prompts"
+        assert all(len(row['generated']) == 4 for row in read_jsonl(run.output_name)), "missing samples"
+        assert score['samples'] == 4 and score['majority_accuracy'] == 1.0 and score['pass@4'] == 1.0, \
+            f"unexpected score: {score}"
+    print("✅ One request per prompt returned every sample and scored correctly")
+
+def test_endpoint_pool():
+    """Balance over a live mock server and a dead port; the dead endpoint must be ejected."""
+    print("\n🧪 Testing endpoint pool failover...")
+
+    from inference_call import run_hf, make_client
+    from evaluate import score_file
+
+    with mock_server_run(rows=20) as run:
+        base_url = f"http://127.0.0.1:{run.server.server_port}/v1,http://127.0.0.1:1/v1"
+        client = make_client(argparse.Namespace(max_retries=8, timeout=10), base_url=base_url, api_key="needlechain")
+        run_hf(client, run.data, run.messages, run.output_name, model_name='QwQ', concurrency=4)
+
+        score, _ = score_file(run.output_name, limit=0)
+        assert score['n'] == 20 and score['accuracy'] == 1.0, f"unexpected score: {score}"
+        live, dead = client.endpoints
+        assert dead.ejected and not live.ejected, client.report()
+        assert live.served == 20 and dead.served == 0, client.report()
+    print("✅ Every row answered by the live endpoint, dead endpoint ejected")
+
+def test_replica_gpu_groups():
+    """Split GPUs into disjoint tensor-parallel groups, one per replica."""
+    from local_model_serve import replica_gpu_groups
+
+    assert replica_gpu_groups('0,1,2,3', 2, 2) == ['0,1', '2,3']
+    assert replica_gpu_groups('0, 1, 2', 1, 2) == ['0', '1']
+    try:
+        replica_gpu_groups('0,1,2', 2, 2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("3 GPUs accepted for 2 replicas x tensor_parallel_size 2")
+    print("✅ GPU groups split per replica")
+
+def test_telemetry_summary():
+    """Throughput over the wall-clock span, failed rows counted, NaN percentiles without data."""
+    import math
+    from telemetry import summarize_rows
+
+    rows = [
+        {'start': 0.0, 'latency': 1.0, 'prompt_tokens': 100, 'completion_tokens': 10, 'finish_reason': 'stop'},
+        {'start': 1.0, 'latency': 1.0, 'prompt_tokens': 100, 'completion_tokens': 30, 'finish_reason': 'length'},
+        {'start': 0.5, 'latency': 0.5, 'error': 'APITimeoutError'},
+    ]
+    summary = summarize_rows(rows)
+    assert summary['n'] == 3 and summary['failed'] == 1 and summary['length_stops'] == 1, summary
+    # 2 answered requests and 40 completion tokens over the 2 s from the first start to the last end
+    assert summary['req_per_s'] == 1.0 and summary['completion_tok_per_s'] == 20.0, summary
+    assert summary['latency_p50'] == 1.0, summary
+    assert math.isnan(summary['ttft_p50']) and math.isnan(summary['ttft_p95']), summary
+    print("✅ Telemetry summarized per group")
+
+def test_sample_scoring():
+    """pass@k and the majority vote with samples that disagree."""
+    import math
+    from evaluate import pass_at_k, score_row
+
+    # n=5 samples with c=2 correct: pass@1 = 2/5, pass@2 = 1 - C(3,2)/C(5,2) = 0.7; n < k is undefined
+    assert [round(p, 9) for p in pass_at_k([5, 5], [2, 2], 1)] == [0.4, 0.4]
+    pass_2 = pass_at_k([5, 5, 1], [2, 0, 1], 2)
+    assert round(pass_2[0], 9) == 0.7 and pass_2[1] == 0.0 and math.isnan(pass_2[2]), pass_2
+    assert pass_at_k([3], [2], 2)[0] == 1.0  # fewer than k wrong samples always pass
+
+    # 7 and 1600 get two votes each; the tie goes to the answer seen first
+    row = {'target': 1600, 'generated': ['## Answer: 7', 'no answer', '## Answer: 1,600', '## Answer: 1600',
+                                         '## Answer: 7']}
+    assert score_row(row) == (False, False, 5, 2, False), score_row(row)
+    row = {'target': 1600, 'generated': ['no answer', '## Answer: 1600', '## Answer: 9']}
+    assert score_row(row) == (False, True, 3, 1, True), score_row(row)
+    print("✅ pass@k and majority vote scored per row")
+
 def main():
     """Run all tests."""
     print("🚀 NeedleChain Simple Functionality Test")
@@ -154,6 +307,13 @@ def main():
         ("Basic Server Start", test_basic_server_start),
         ("Complete Pipeline", test_complete_pipeline),
         ("Fallback Script", test_fallback_script),
+        ("Mock Server Pipeline", test_mock_server_pipeline),
+        ("Mock Server Early Stop", test_mock_server_early_stop),
+        ("Mock Server Samples", test_mock_server_samples),
+        ("Endpoint Pool", test_endpoint_pool),
+        ("Replica GPU Groups", test_replica_gpu_groups),
+        ("Telemetry Summary", test_telemetry_summary),
+        ("Sample Scoring", test_sample_scoring),
     ]
     
     passed = 0
@@ -162,7 +322,12 @@ def main():
         print(f"Running: {test_name}")
         print('='*50)
         
-        if test_func():
+        try:
+            ok = test_func() is not False  # assert-based tests return None
+        except AssertionError as e:
+            print(f"❌ {e}")
+            ok = False
+        if ok:
             print(f"✅ {test_name}: PASSED")
             passed += 1
         else:
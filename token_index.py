@@ -0,0 +1,115 @@
+"""
+Token-length index for datasets.
+
+Tokenizes every rendered prompt (all chain_type x question_type combinations) once per
+tokenizer family and stores the lengths in a sidecar next to the dataset:
+
+    data/k50---val1600.jsonl  ->  data/k50---val1600.tokens-qwen2.npz
+
+The runner reads the sidecar to skip prompts that do not fit the context, size ``max_tokens``
+and order requests by length, without loading a tokenizer.
+
+Usage:
+    python token_index.py --model_name QwQ --k 5,10,20,50,100,200
+"""
+
+import os
+import argparse
+
+import numpy as np
+
+from utils import model_arg_dict, chat_template_dict, tokenizer_family_dict, read_file
+from inference_call import dataset_path, load_dataset, build_prompts
+
+CHAIN_TYPES = ['parallel', 'forward', 'backward', 'chaotic']
+QUESTION_TYPES = ['single', 'total']
+
+
+def tokenizer_family(model_name):
+    return tokenizer_family_dict.get(model_name, model_name)
+
+
+def index_path(dataset_filename, family):
+    root, _ = os.path.splitext(dataset_filename)
+    return f'{root}.tokens-{family}.npz'
+
+
+def source_stamp(dataset_filename):
+    stat = os.stat(dataset_filename)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def load_tokenizer(model_name, tokenizer_path=None):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_path or model_arg_dict.get(model_name, model_name),
+                                              use_fast=True)
+    if model_name in chat_template_dict and os.path.exists(chat_template_dict[model_name]):
+        # read_file returns the lines; the tokenizer needs the Jinja template as one string
+        tokenizer.chat_template = ''.join(read_file(chat_template_dict[model_name]))
+    return tokenizer
+
+
+def render_chat(tokenizer, message):
+    if getattr(tokenizer, 'chat_template', None):
+        return tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=True)
+    return '\n'.join(m['content'] for m in message)
+
+
+def count_tokens(tokenizer, texts, batch_size=512):
+    """Token counts of ``texts``, tokenized in batches by the (fast) tokenizer."""
+    lengths = np.empty(len(texts), dtype=np.int32)
+    for start in range(0, len(texts), batch_size):
+        encoded = tokenizer(texts[start:start + batch_size], add_special_tokens=False,
+                            return_attention_mask=False)['input_ids']
+        lengths[start:start + len(encoded)] = [len(ids) for ids in encoded]
+    return lengths
+
+
+def build_index(tokenizer, family, k, val=1600, data_dir='./data', batch_size=512):
+    dataset_filename = dataset_path(k, val, data_dir)
+    rows = list(load_dataset(k, val, data_dir))
+    arrays = {'idx': np.array([row['idx'] for row in rows], dtype=np.int64),
+              'source': source_stamp(dataset_filename)}
+    for chain_type in CHAIN_TYPES:
+        for question_type in QUESTION_TYPES:
+            messages, _ = build_prompts(rows, chain_type, question_type)
+            texts = [render_chat(tokenizer, message) for message in messages]
+            arrays[f'{chain_type}_{question_type}'] = count_tokens(tokenizer, texts, batch_size)
+    filename = index_path(dataset_filename, family)
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+    longest = max(int(arrays[key].max()) for key in arrays if key not in ('idx', 'source'))
+    print(f'index saved: {filename} ({len(rows)} rows, longest prompt {longest} tokens)')
+    return filename
+
+
+def load_token_lengths(dataset_filename, family, chain_type, question_type):
+    """Return {idx: prompt tokens} from the sidecar index, or None if it is missing or stale."""
+    filename = index_path(dataset_filename, family)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as f:
+        if not np.array_equal(f['source'], source_stamp(dataset_filename)):
+            print(f'ignoring stale token index: {filename}')
+            return None
+        return dict(zip(f['idx'].tolist(), f[f'{chain_type}_{question_type}'].tolist()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', default='QwQ', help='model whose tokenizer family is indexed')
+    parser.add_argument('--tokenizer', default=None, help='tokenizer path or HF id (default: from model_arg_dict)')
+    parser.add_argument('--k', default='5,10,20,50,100,200', help='comma-separated k values to index')
+    parser.add_argument('--val', type=int, default=1600)
+    parser.add_argument('--data_dir', default='./data')
+    parser.add_argument('--batch_size', type=int, default=512, help='prompts per tokenizer call')
+    args = parser.parse_args()
+
+    tokenizer = load_tokenizer(args.model_name, args.tokenizer)
+    family = tokenizer_family(args.model_name)
+    for k in args.k.split(','):
+        if not os.path.exists(dataset_path(k, args.val, args.data_dir)):
+            print(f'skip k={k}: no dataset in {args.data_dir}')
+            continue
+        build_index(tokenizer, family, k, args.val, args.data_dir, args.batch_size)